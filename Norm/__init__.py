@@ -6,8 +6,9 @@ Josh Marshall 2010
 
 from Norm.connection import connect, cursor
 from Norm.model import Model
+from Norm.session import Session
 from Norm.fields import PrimaryField, IntField, IntegerField, FloatField
 from Norm.fields import BoolField, BooleanField, ListField, DictField
 from Norm.fields import ReferenceField, ReferenceManyToManyField
 from Norm.fields import TimestampField, UpdatedField, CreatedField
-from Norm.fields import UnicodeField, ReferenceManyField
+from Norm.fields import UnicodeField, ReferenceManyField, Index
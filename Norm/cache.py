@@ -0,0 +1,415 @@
+"""
+NORM cache.py
+
+Josh Marshall 2010
+This file contains the LRUCache class, and the query cache
+(QueryCache) with its in-process and file backends.
+"""
+
+import os
+import time
+import hashlib
+import tempfile
+from Norm.connection import connection
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+class LRUCache(object):
+    """
+    A dict-like cache that holds at most max_size entries (and, if
+    max_bytes is set, at most that many bytes, going by the sizes
+    given to set()), dropping the least recently used ones when it
+    fills up. It counts hits and misses, so stats() shows how well
+    it's covering the lookups made against it.
+    """
+
+    def __init__(self, max_size=500, max_bytes=None):
+        assert max_size is None or max_size > 0
+        assert max_bytes is None or max_bytes > 0
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # key -> [last used tick, value, size]
+        self._entries = {}
+        self._tick = 0
+        self._bytes = 0
+
+    def get(self, key, default=None):
+        """
+        Returns the value for the key (marking it as just used),
+        or default.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._tick += 1
+        entry[0] = self._tick
+        return entry[1]
+
+    def set(self, key, value, size=0):
+        """
+        Stores a value, trimming the cache if it's over max_size
+        or max_bytes. A value bigger than max_bytes isn't kept.
+        """
+        if self.max_bytes is not None and size > self.max_bytes:
+            self.pop(key)
+            return
+        self._tick += 1
+        old = self._entries.get(key)
+        if old is not None:
+            self._bytes -= old[2]
+        self._entries[key] = [self._tick, value, size]
+        self._bytes += size
+        if (self.max_size is not None and 
+            len(self._entries) > self.max_size) or \
+            (self.max_bytes is not None and self._bytes > self.max_bytes):
+            self.trim()
+
+    def pop(self, key):
+        """
+        Removes a key if it's there.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    def trim(self):
+        """
+        Drops the least recently used entries until a quarter of
+        max_size (and of max_bytes) is free. Doing it in one go
+        keeps set() cheap on average.
+        """
+        entries = sorted(self._entries.items(), key=lambda item: item[1][0])
+        count = len(entries)
+        keep_size = count
+        if self.max_size is not None:
+            keep_size = self.max_size - self.max_size // 4
+        keep_bytes = self._bytes
+        if self.max_bytes is not None:
+            keep_bytes = self.max_bytes - self.max_bytes // 4
+        for key, entry in entries:
+            if count <= keep_size and self._bytes <= keep_bytes:
+                break
+            self.pop(key)
+            count -= 1
+
+    def clear(self):
+        """
+        Empties the cache and resets the counters.
+        """
+        self._entries = {}
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """
+        Returns a dict of hits, misses, hit_rate, the number
+        of entries and their total size in bytes.
+        """
+        lookups = self.hits + self.misses
+        hit_rate = 0.0
+        if lookups:
+            hit_rate = float(self.hits) / lookups
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': hit_rate,
+            'size': len(self._entries),
+            'bytes': self._bytes
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+class RowCursor(object):
+    """
+    Stands in for a MySQLdb cursor over rows that were already
+    fetched, so Results can read a cached result set the same way
+    it reads a buffered one.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.rowcount = len(rows)
+        self.position = 0
+
+    def fetchone(self):
+        if self.position >= self.rowcount:
+            return None
+        self.position += 1
+        return self.rows[self.position - 1]
+
+    def fetchmany(self, size=1):
+        rows = self.rows[self.position:self.position + size]
+        self.position += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self.rows[self.position:]
+        self.position = self.rowcount
+        return rows
+
+    def scroll(self, value, mode='relative'):
+        if mode == 'absolute':
+            self.position = value
+        else:
+            self.position += value
+
+    def close(self):
+        pass
+
+class MemoryBackend(object):
+    """
+    Keeps query cache entries in this process, in an LRUCache of
+    at most max_bytes (by estimate_size()), so a few wide result
+    sets can't crowd out the memory a thousand narrow ones would.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, max_size=None):
+        self.entries = LRUCache(max_size, max_bytes=max_bytes)
+        self.generations = {}
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def set(self, key, value):
+        self.entries.set(key, value, estimate_size(key) + estimate_size(value))
+
+    def generation(self, table):
+        """
+        A value that changes every time bump() is called for the
+        table, so keys built from it go stale.
+        """
+        return self.generations.get(table, 0)
+
+    def bump(self, table):
+        self.generations[table] = self.generations.get(table, 0) + 1
+
+    def clear(self):
+        self.entries.clear()
+        self.generations = {}
+
+def estimate_size(value):
+    """
+    A rough guess at how many bytes a cache key or entry takes up
+    in memory, counting its strings and a fixed overhead for every
+    other object (including each row and tuple).
+    """
+    if isinstance(value, (tuple, list)):
+        size = 56 + 8 * len(value)
+        for item in value:
+            size += estimate_size(item)
+        return size
+    elif isinstance(value, unicode):
+        return 50 + len(value) * 4
+    elif isinstance(value, str):
+        return 37 + len(value)
+    elif isinstance(value, dict):
+        size = 280
+        for key, item in value.iteritems():
+            size += estimate_size(key) + estimate_size(item)
+        return size
+    return 24
+
+class FileBackend(object):
+    """
+    Keeps query cache entries as pickles in a directory, so worker
+    processes on the same host can share them. Files are written
+    to a temporary name and renamed into place, so readers never
+    see half an entry. Past max_size files, the least recently
+    read ones are removed.
+    """
+
+    # How many set() calls go by between checks on the file count.
+    trim_every = 100
+
+    def __init__(self, path, max_size=10000):
+        self.path = path
+        self.max_size = max_size
+        self._sets = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def get_path(self, key):
+        """
+        The file an entry (or a table generation) lives in.
+        """
+        return os.path.join(self.path, hashlib.md5(repr(key)).hexdigest())
+
+    def read(self, path):
+        """
+        Returns the unpickled contents of a file, or None.
+        """
+        try:
+            cache_file = open(path, 'rb')
+            try:
+                return pickle.load(cache_file)
+            finally:
+                cache_file.close()
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def write(self, path, value):
+        """
+        Pickles a value into place.
+        """
+        handle, temp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        temp_file = os.fdopen(handle, 'wb')
+        try:
+            pickle.dump(value, temp_file, pickle.HIGHEST_PROTOCOL)
+        finally:
+            temp_file.close()
+        os.rename(temp_path, path)
+
+    def get(self, key):
+        path = self.get_path(key) + '.cache'
+        value = self.read(path)
+        if value is not None:
+            try:
+                # The access time is what trim() goes by.
+                os.utime(path, None)
+            except OSError:
+                pass
+        return value
+
+    def set(self, key, value):
+        self.write(self.get_path(key) + '.cache', value)
+        self._sets += 1
+        if self._sets % self.trim_every == 0:
+            self.trim()
+
+    def trim(self):
+        """
+        Removes the least recently read quarter of the entries if
+        there are more than max_size.
+        """
+        paths = [os.path.join(self.path, name) 
+            for name in os.listdir(self.path) if name.endswith('.cache')]
+        if len(paths) <= self.max_size:
+            return
+        entries = []
+        for path in paths:
+            try:
+                entries.append((os.path.getmtime(path), path))
+            except OSError:
+                pass
+        entries.sort()
+        keep = self.max_size - self.max_size // 4
+        for mtime, path in entries[:len(entries) - keep]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def generation(self, table):
+        """
+        A random token rewritten by every bump(), so concurrent
+        bumps from several processes can't land on the same value.
+        """
+        return self.read(self.get_path(('generation', table)))
+
+    def bump(self, table):
+        self.write(self.get_path(('generation', table)), 
+            os.urandom(8).encode('hex'))
+
+    def clear(self):
+        for name in os.listdir(self.path):
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+class QueryCache(object):
+    """
+    The opt-in cache for Results rows, keyed on the final SQL and
+    the bound values. Entries last ttl seconds, and every write to
+    a table (through Model or Results) invalidates the entries that
+    read from it, by bumping the table's generation in the backend.
+    Result sets longer than max_rows aren't kept.
+    """
+
+    def __init__(self, backend=None, ttl=60, max_rows=1000):
+        if backend is None:
+            backend = MemoryBackend()
+        self.backend = backend
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, **kwargs):
+        """
+        Changes any of the settings (backend, ttl, max_rows).
+        """
+        for key, value in kwargs.iteritems():
+            if key not in ['backend', 'ttl', 'max_rows']:
+                raise TypeError('Unknown cache setting %s' % key)
+            setattr(self, key, value)
+        return self
+
+    def fetch(self, tables, sql, values, ttl=None):
+        """
+        Returns the rows for a SELECT that reads from the given
+        tables, from the cache if they're there and fresh, and
+        otherwise from the database (keeping them for next time).
+        """
+        if ttl is None:
+            ttl = self.ttl
+        # The generations are read before the query runs, so a write
+        # that lands in the meantime leaves this entry stale.
+        generations = [(table, self.backend.generation(table)) 
+            for table in tables]
+        key = (sql, tuple(values), tuple(generations))
+        now = time.time()
+        entry = self.backend.get(key)
+        if entry is not None and entry[0] > now:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        cursor = connection.execute(sql, values)
+        rows = cursor.fetchall()
+        connection.release_cursor(cursor)
+        if len(rows) <= self.max_rows:
+            self.backend.set(key, (now + ttl, rows))
+        return rows
+
+    def invalidate(self, table):
+        """
+        Marks every entry that read from the table as stale.
+        """
+        self.backend.bump(table)
+
+    def clear(self):
+        """
+        Empties the backend and resets the counters.
+        """
+        self.backend.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """
+        Returns a dict of hits, misses and hit_rate.
+        """
+        lookups = self.hits + self.misses
+        hit_rate = 0.0
+        if lookups:
+            hit_rate = float(self.hits) / lookups
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': hit_rate
+        }
+
+# The query cache singleton.
+query_cache = QueryCache()
@@ -2,12 +2,14 @@
 NORM connection.py
 
 Josh Marshall 2010
-This file contains the Connection class.
+This file contains the Connection and ConnectionPool classes.
 """
 
 import re
+import time
 import MySQLdb
 import logging
+import threading
 import traceback
 
 class NullHandler(logging.Handler):
@@ -21,6 +23,9 @@ class NullHandler(logging.Handler):
 NORM_LOGGER = logging.getLogger('Norm')
 NORM_LOGGER.addHandler(NullHandler())
 
+# Anything but printable ASCII (and whitespace) in a byte string.
+BINARY = re.compile('[^\x20-\x7e\t\r\n]')
+
 class Connection(object):
     """ 
     The Connection class is a simple wrapper around the
@@ -34,8 +39,9 @@ class Connection(object):
         self.port = None
         self.db = None
         self.connection = None
-        self._cursor = None
+        self._max_packet = None
         self.verbose = False
+        self.last_used = time.time()
         self.logger = logging.getLogger('Norm')
     
     def connect(self, db_uri, verbose=False):
@@ -88,50 +94,385 @@ class Connection(object):
             self.port = result.group('port')
             self.db = result.group('db')
             
-    def execute(self, command, values=()):
+    def execute(self, command, values=(), cursor=None):
         """
-        Simply a wrapper around the MySQLdb execute method        
+        Simply a wrapper around the MySQLdb execute method. Runs
+        on the cursor passed in, or on a fresh one from the cursor
+        property. Either way, the caller owns the returned cursor
+        and should hand it back with release_cursor().
         """
-        log_message = '%s@%s using %s: %s' % (
-            self.user,
-            self.host,
-            self.db,
-            command % tuple(values)
-        )
-        self.logger.debug(log_message)
-        if self.verbose:
-            print log_message
-        new_cursor = self.cursor
-        new_cursor.execute(command, values)
-        return new_cursor
+        if self.verbose or self.logger.isEnabledFor(logging.DEBUG):
+            log_message = '%s@%s using %s: %s' % (
+                self.user,
+                self.host,
+                self.db,
+                command % tuple([log_value(value) for value in values])
+            )
+            self.logger.debug(log_message)
+            if self.verbose:
+                print log_message
+        if not cursor:
+            cursor = self.cursor
+        cursor.execute(command, values)
+        self.last_used = time.time()
+        return cursor
 
     @property
     def cursor(self):
         """
-        Closes an open cursor (if applicable) and returns
-        a new one from the current conneection.
+        Returns a new cursor from the current connection. Cursors
+        are never shared, so several result sets can be read side
+        by side.
+        """
+        return self.connection.cursor()
+        
+    def release_cursor(self, cursor):
+        """
+        Closes a cursor from execute(). They aren't kept for reuse,
+        since a buffered cursor holds on to all of its rows until
+        it's executed again, and new ones are cheap.
+        """
+        cursor.close()
+        
+    def ping(self):
+        """
+        Returns True if the server is still answering on this
+        connection, False otherwise.
+        """
+        if not self.connection:
+            return False
+        try:
+            self.connection.ping()
+        except MySQLdb.Error:
+            return False
+        return True
+        
+    def insert_id(self):
+        """
+        The id generated by the last INSERT on this connection.
         """
-        if self._cursor:
-            self._cursor.close()
-        self._cursor = self.connection.cursor()
-        return self._cursor
+        return self.connection.insert_id()
+        
+    def max_allowed_packet(self):
+        """
+        The server's max_allowed_packet, in bytes. Only asked
+        for once per connection.
+        """
+        if self._max_packet is None:
+            cursor = self.execute(u'SELECT @@max_allowed_packet;')
+            self._max_packet = int(cursor.fetchone()[0])
+            self.release_cursor(cursor)
+        return self._max_packet
         
     def close(self):
         """
         Attemps to close the current connection and cursor.
         """
         if self.connection:
-            if self._cursor:
-                self._cursor.close()
-                self._cursor = None
             self.connection.close()
             self.connection = None
             
     def __del__(self):
         self.close()
+        
+class ConnectionPool(object):
+    """
+    The ConnectionPool keeps a set of Connections and hands one
+    to each thread that asks for it. A thread keeps its Connection
+    (so things like insert_id() stay on the same session) until
+    it calls release(), or until the thread dies and the pool
+    reclaims it. It exposes the same execute() / cursor interface
+    as a single Connection, so callers don't need to know.
+    """
+    
+    def __init__(self, min_size=1, max_size=10, idle_timeout=300,
+        checkout_timeout=30, ping_interval=60):
+        self.db_uri = None
+        self.verbose = False
+        self.min_size = min_size
+        self.max_size = max_size
+        # Seconds an unused Connection may sit in the pool
+        # before it is closed (as long as we're above min_size).
+        self.idle_timeout = idle_timeout
+        # Seconds to wait for a free Connection. None waits forever.
+        self.checkout_timeout = checkout_timeout
+        # Seconds a thread's Connection may go unused before it's
+        # pinged again on the thread's next query.
+        self.ping_interval = ping_interval
+        self._idle = []
+        self._in_use = {}
+        self._dedicated = []
+        # Thread Connections handed to checkout(dedicated=True)
+        # because the pool was full, by the thread they go back to.
+        self._lent = {}
+        self._size = 0
+        self._lock = threading.Condition()
+        self.logger = logging.getLogger('Norm')
+        
+    def connect(self, db_uri, verbose=False, **kwargs):
+        """
+        Stores the DB URI and opens min_size connections. Any of
+        the pool settings (min_size, max_size, idle_timeout,
+        checkout_timeout, ping_interval) can be passed as keyword
+        arguments.
+        """
+        if self.connected:
+            self.close()
+        for key, value in kwargs.iteritems():
+            if key not in ['min_size', 'max_size', 'idle_timeout',
+                'checkout_timeout', 'ping_interval']:
+                raise TypeError('Unknown pool setting %s' % key)
+            setattr(self, key, value)
+        assert 0 <= self.min_size <= self.max_size
+        self.db_uri = db_uri
+        self.verbose = verbose
+        self._lock.acquire()
+        try:
+            while self._size < self.min_size:
+                self._idle.append(self._new_connection())
+        finally:
+            self._lock.release()
+        return self
+        
+    @property
+    def connected(self):
+        """
+        Whether connect() has been called with a DB URI.
+        """
+        if self.db_uri:
+            return True
+        return False
+        
+    def _new_connection(self):
+        """
+        Opens a new Connection. Must be called with the lock held.
+        """
+        conn = Connection().connect(self.db_uri, verbose=self.verbose)
+        self._size += 1
+        return conn
+        
+    def _discard(self, conn):
+        """
+        Closes a Connection and forgets about it. Must be called
+        with the lock held.
+        """
+        self._size -= 1
+        try:
+            conn.close()
+        except Exception:
+            self.logger.error("Can't close connection: %s", 
+                traceback.format_exc().splitlines()[-1])
+                
+    def _reclaim(self):
+        """
+        Returns Connections held by threads that have since died.
+        Must be called with the lock held.
+        """
+        for thread, conn in self._in_use.items():
+            if not thread.isAlive():
+                del self._in_use[thread]
+                conn.last_used = time.time()
+                self._idle.append(conn)
+                
+    def evict_idle(self):
+        """
+        Closes Connections that have been idle longer than
+        idle_timeout, leaving at least min_size open.
+        """
+        self._lock.acquire()
+        try:
+            now = time.time()
+            # Oldest connections are at the front of the list.
+            while self._idle and self._size > self.min_size:
+                if now - self._idle[0].last_used < self.idle_timeout:
+                    break
+                self._discard(self._idle.pop(0))
+        finally:
+            self._lock.release()
+            
+    def checkout(self, dedicated=False):
+        """
+        Returns the Connection for the current thread, pulling one
+        from the pool (or opening one) if the thread doesn't have one
+        yet. Idle Connections are pinged before they are handed out,
+        and so is the thread's own once it's gone ping_interval
+        seconds without a query, so a Connection the server dropped
+        is replaced instead of failing every query after it.
+        
+        With dedicated=True, the Connection isn't tied to the thread
+        at all -- it belongs to the caller until checkin(). That's
+        for things like streaming cursors that tie up a session. If
+        the pool is full, the thread's own Connection is lent out
+        rather than waiting on one it may be holding itself.
+        """
+        if not self.connected:
+            raise Exception('Not connected to the database.')
+        thread = threading.currentThread()
+        conn = self._in_use.get(thread)
+        if conn and not dedicated:
+            if time.time() - conn.last_used < self.ping_interval or \
+                conn.ping():
+                return conn
+            self.logger.warning('Dropping dead connection.')
+            self._lock.acquire()
+            try:
+                if self._in_use.get(thread) is conn:
+                    del self._in_use[thread]
+                    self._discard(conn)
+            finally:
+                self._lock.release()
+        self.evict_idle()
+        start = time.time()
+        waiting = False
+        self._lock.acquire()
+        try:
+            while True:
+                if not self._idle and self._size >= self.max_size:
+                    self._reclaim()
+                if self._idle:
+                    conn = self._idle.pop()
+                    if not conn.ping():
+                        self.logger.warning('Dropping dead connection.')
+                        self._discard(conn)
+                        continue
+                    break
+                if self._size < self.max_size:
+                    conn = self._new_connection()
+                    break
+                if dedicated and thread in self._in_use:
+                    conn = self._in_use.pop(thread)
+                    self._lent[conn] = thread
+                    break
+                if thread in self._lent.values():
+                    # Rather than maybe waiting forever on the one this
+                    # thread is streaming from.
+                    raise Exception('No free connection while this '
+                        'thread is streaming.')
+                if not waiting:
+                    waiting = True
+                    self.logger.warning('All %s connections are checked '
+                        'out, waiting for one. Threads should release() '
+                        'theirs when they finish.', self.max_size)
+                if self.checkout_timeout is None:
+                    self._lock.wait()
+                    continue
+                remaining = self.checkout_timeout - (time.time() - start)
+                if remaining <= 0:
+                    raise Exception('Timed out waiting for a connection.')
+                self._lock.wait(remaining)
+            if dedicated:
+                self._dedicated.append(conn)
+            else:
+                self._in_use[thread] = conn
+        finally:
+            self._lock.release()
+        return conn
+        
+    def checkin(self, conn):
+        """
+        Returns a Connection from checkout(dedicated=True) to the pool.
+        """
+        self._lock.acquire()
+        try:
+            if conn in self._dedicated:
+                self._dedicated.remove(conn)
+                conn.last_used = time.time()
+                thread = self._lent.pop(conn, None)
+                if thread is not None and thread.isAlive() and \
+                    thread not in self._in_use:
+                    # Back to the thread it was lent from.
+                    self._in_use[thread] = conn
+                    return
+                self._idle.append(conn)
+                self._lock.notify()
+        finally:
+            self._lock.release()
+        
+    def release(self):
+        """
+        Returns the current thread's Connection to the pool. Worker
+        threads should call this when they finish a unit of work.
+        """
+        thread = threading.currentThread()
+        self._lock.acquire()
+        try:
+            conn = self._in_use.pop(thread, None)
+            if conn:
+                conn.last_used = time.time()
+                self._idle.append(conn)
+                self._lock.notify()
+        finally:
+            self._lock.release()
+        
+    def execute(self, command, values=(), cursor=None):
+        """
+        Runs the command on the current thread's Connection.
+        """
+        return self.checkout().execute(command, values, cursor)
+        
+    @property
+    def cursor(self):
+        """
+        A cursor from the current thread's Connection.
+        """
+        return self.checkout().cursor
+        
+    def release_cursor(self, cursor):
+        """
+        Closes a cursor from this thread's execute(), freeing its
+        rows (see Connection.release_cursor()).
+        """
+        cursor.close()
+        
+    @property
+    def connection(self):
+        """
+        The raw MySQLdb connection for the current thread.
+        """
+        return self.checkout().connection
+        
+    def insert_id(self):
+        """
+        The id generated by the last INSERT on this thread.
+        """
+        return self.checkout().insert_id()
+        
+    def max_allowed_packet(self):
+        """
+        The server's max_allowed_packet for this thread's Connection.
+        """
+        return self.checkout().max_allowed_packet()
+        
+    def close(self):
+        """
+        Closes every Connection, idle or checked out, and
+        forgets the DB URI.
+        """
+        self._lock.acquire()
+        try:
+            for conn in self._idle + self._in_use.values() + self._dedicated:
+                self._discard(conn)
+            self._idle = []
+            self._in_use = {}
+            self._dedicated = []
+            self._lent = {}
+            self.db_uri = None
+            self._lock.notifyAll()
+        finally:
+            self._lock.release()
                        
-# The connection singleton.
-connection = Connection()  
+# The connection pool singleton.
+connection = ConnectionPool()  
+
+def log_value(value):
+    """
+    A value as it's shown in a logged statement. Binary strings
+    (like compressed or marshalled columns) are just summed up,
+    since they can't be mixed into the unicode SQL.
+    """
+    if type(value) is str and BINARY.search(value):
+        return '<%d bytes>' % len(value)
+    return value
 
 def connect(*args, **kwargs):
     """ The connect function """
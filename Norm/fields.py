@@ -9,38 +9,42 @@ TODO: Add FloatField, BoolField, etc.
 
 import types
 import datetime
+import zlib
 
 try:
     import json
 except ImportError:
     import simplejson as json
     
-class LateProperty(object):
+# The first byte of a compressed column says how the rest is stored,
+# so the method can change without breaking existing rows.
+STORED = '\x00'
+ZLIB = '\x01'
+
+# Compressed columns shorter than this (in bytes) are just stored.
+COMPRESS_THRESHOLD = 512
+
+class Deferred(object):
     """
-    A helper class that ensures properties from subclasses are 
-    pulled from the proper class.
+    The type of DEFERRED, which stands in for the raw value of a
+    column that Results.only() / defer() left out of the SELECT.
     """
-    def __init__(self, getter=None, setter=None, deleter=None):
-        self.getter = getter
-        self.setter = setter
-        self.deleter = deleter
-    
-    def __get__(self, inst, owner):
-        if inst != None:
-            return getattr(inst, self.getter.__name__)()
-        else:
-            return getattr(owner, self.getter.__name__)()
-       
-    def __set__(self, inst, value):
-        inst._updated = True
-        return getattr(inst, self.setter.__name__)(value)
+    def __repr__(self):
+        return 'DEFERRED'
         
-    def __del__(self, inst):
-        return getattr(inst, self.deleter.__name__)()
-
+    def __reduce__(self):
+        # Unpickles as the DEFERRED singleton, so 'is' still works.
+        return 'DEFERRED'
+        
+DEFERRED = Deferred()
+    
 class Field(object):
     """
     The base field class, not to be used directly.
+    
+    Fields live on the Model class and act as descriptors: an
+    instance only keeps the raw column values (in its _values list,
+    at the Field's slot) and a bitmask of which ones changed.
     """
     format = u'%s'
     field = None
@@ -49,7 +53,6 @@ class Field(object):
     auto_value = False
     default = None
     _value = None
-    _updated = False
     
     def __init__(self, *args, **kwargs):
         """
@@ -63,26 +66,47 @@ class Field(object):
         self.args = args
         self.kwargs = kwargs
         self.model = None
+        # Set by Model.parse_attributes().
+        self.name = None
+        self.slot = None
         
-    def get_value(self):
+    def __get__(self, inst, owner):
+        if inst is None:
+            return self
+        value = inst._values[self.slot]
+        if value is DEFERRED:
+            value = inst.load_deferred(self.name)
+        return self.read_value(value)
+        
+    def __set__(self, inst, value):
+        inst._values[self.slot] = self.write_value(value)
+        inst._dirty |= 1 << self.slot
+        
+    def read_value(self, value):
         """
-        This is the getter property so that sub-classes can do
-        other fun things with it.
+        Converts a raw column value into what the model attribute
+        returns. Sub-classes convert things here.
         """
-        return self._value
+        return value
         
     def set_value(self, value):
         """
-        Pretty self-explanatory -- basic type checking.
+        Stores the converted default value, which new instances
+        start out with.
+        """
+        self._value = self.write_value(value)
+        
+    def write_value(self, value):
+        """
+        Basic type checking, and returns the raw value that goes
+        to the column. Sub-classes convert things here.
         """
         if value is None:
             if not getattr(self, 'null', True):
                 raise TypeError('Column does not allow null values.')
         elif type(value) is not self.type:
             raise TypeError('Value must be type %s' % self.type)
-        self._value = value
-        
-    value = LateProperty(get_value, set_value)
+        return value
         
     def set_model(self, model):
         """
@@ -107,19 +131,58 @@ class UnicodeField(Field):
     Will eventually be the "catch-all" text field -- a VARCHAR for
     short strings, and a TEXT etc. for long strings. It will also
     do length validation.
+    
+    With compress=True, values of compress_threshold bytes or more
+    are zlib compressed into a BLOB column (see compress_value()),
+    and only decompressed the first time the attribute is read on
+    an instance.
     """
     type = types.UnicodeType
+    compress = False
+    compress_threshold = COMPRESS_THRESHOLD
     
     def __init__(self, *args, **kwargs):
         self.length = kwargs.get('length', None)
         Field.__init__(self, **kwargs)
+        # Whether reads are decoded once and kept on the instance.
+        self.memoize = self.compress
         
-    def set_value(self, value):
+    def __get__(self, inst, owner):
+        if inst is None:
+            return self
+        raw = inst._values[self.slot]
+        if raw is DEFERRED:
+            raw = inst.load_deferred(self.name)
+        if not self.memoize or raw is None:
+            return self.read_value(raw)
+        cache = inst.get_cache()
+        decoded = cache.get(self.name)
+        if decoded is not None and decoded[0] is raw:
+            return decoded[1]
+        value = self.read_value(raw)
+        cache[self.name] = (raw, value)
+        return value
+        
+    def __set__(self, inst, value):
+        Field.__set__(self, inst, value)
+        if self.memoize and inst._cache:
+            inst._cache.pop(self.name, None)
+        
+    def write_value(self, value):
         if type(value) is types.StringType:
             # Dangerous assumption?
             if type(value) is not unicode:
                 value = unicode(value)
-        Field.set_value(self, value)
+        value = Field.write_value(self, value)
+        if self.compress and value is not None:
+            value = compress_value(value.encode('utf-8'), 
+                self.compress_threshold)
+        return value
+        
+    def read_value(self, value):
+        if self.compress and value is not None:
+            value = decompress_value(value).decode('utf-8')
+        return value
         
     @property
     def field(self):
@@ -127,6 +190,8 @@ class UnicodeField(Field):
         Overwriting the 'field' attribute to determine the
         column SQL based on length.
         """
+        if self.compress:
+            return u'BLOB'
         if not self.length:
             return u'TEXT' 
         elif self.length > 255:
@@ -136,26 +201,54 @@ class UnicodeField(Field):
         
 class DictField(UnicodeField):
     """
-    Stores a Dict in JSON format.
+    Stores a Dict in JSON format -- or with whatever codec is passed
+    in, which is anything with dumps() and loads() (like marshal or
+    cPickle). Codecs other than json get a BLOB column, unless
+    binary=False is passed too. compress=True works like it does
+    for UnicodeField.
+    
+    The column is only decoded the first time the attribute is read,
+    and the result is kept on the instance until the next set. So
+    changes made to the returned object in place show up on later
+    reads, but (as before) are only saved once it's assigned back.
     """
     type = types.DictType
+    codec = json
     
-    def set_value(self, value):
+    def __init__(self, *args, **kwargs):
+        UnicodeField.__init__(self, **kwargs)
+        self.binary = kwargs.get('binary', self.codec is not json)
+        self.memoize = True
+        
+    @property
+    def field(self):
+        if self.binary:
+            return u'BLOB'
+        return UnicodeField.field.fget(self)
+    
+    def write_value(self, value):
         if value == None: 
             if not getattr(self, 'null', True):
                 raise TypeError('Column does not allow null values.')
+            return None
         elif type(value) != self.type:
             raise TypeError('Value must be of type %s' % self.type)
-        json_string = json.dumps(value)
-        self._value = json_string
+        value = self.codec.dumps(value)
+        if self.compress:
+            if type(value) is unicode:
+                value = value.encode('utf-8')
+            value = compress_value(value, self.compress_threshold)
+        return value
         
-    def get_value(self):
-        if self._value == None:
+    def read_value(self, value):
+        if value == None:
             return None
-        obj = self._value
+        obj = value
+        if self.compress:
+            obj = decompress_value(obj)
         while type(obj) != self.type:
             # Doing this because of MySQLdb escaping
-            obj = json.loads(obj)
+            obj = self.codec.loads(obj)
         return obj
             
 class ListField(DictField):
@@ -164,10 +257,10 @@ class ListField(DictField):
     """
     type = types.ListType
     
-    def set_value(self, value):
+    def write_value(self, value):
         if type(value) is tuple:
             value = list(value)
-        DictField.set_value(self, value)
+        return DictField.write_value(self, value)
         
 class FloatField(Field):
     """
@@ -187,18 +280,22 @@ class IntField(Field):
     type = types.LongType
     field = 'INT'
     
-    def set_value(self, value):
+    def write_value(self, value):
         if type(value) is types.IntType:
             value = long(value)
-        Field.set_value(self, value)
+        return Field.write_value(self, value)
     
-    def create_syntax(self):
+    def create_syntax(self, inline_key=True):
+        """
+        With inline_key=False, a primary is left for a table-level
+        PRIMARY KEY (like the one a partitioned table needs).
+        """
         sql = 'INT'
         if getattr(self, 'unsigned', False):
             sql += ' UNSIGNED'
         if not getattr(self, 'null', True):
             sql += ' NOT NULL'
-        if getattr(self, 'primary', False):
+        if inline_key and getattr(self, 'primary', False):
             sql += ' PRIMARY KEY'
         if getattr(self, 'unique', False) and not getattr(self, 'index', False):
             sql += ' UNIQUE'
@@ -214,18 +311,19 @@ class BoolField(IntField):
     """
     type = types.BooleanType
 
-    def set_value(self, value):
+    def write_value(self, value):
         if value is None:
             if not getattr(self, 'null', True):
                 raise ValueError('This field does not accept null values.')
-            self._value = None
+            return None
         elif value:
-            self._value = 1
+            return 1
         else:
-            self._value = 0
+            return 0
 
-    def get_value(self):
-        value = self._value
+    def read_value(self, value):
+        if value is None:
+            return None
         if type(value) != types.IntType:
             value = int(value)
         if value > 0:
@@ -292,17 +390,20 @@ class PrimaryField(IntField):
             
         IntField.__init__(self, *args, **kwargs)
         
-    def set_value(self, value):
+    def write_value(self, value):
         if type(value) is types.IntType:
             value = long(value)
-        return IntField.set_value(self, value)
+        return IntField.write_value(self, value)
         
 class ReferenceField(IntField):
     """
     This is the auto-loading (hopefully lazy) foreign model 
     field. When the value attribute is referenced, it 
-    calls the get method on the foreign model.
+    calls the get method on the foreign model -- unless
+    select_related() already put the instance in the
+    model instance's cache.
     """
+    
     def __init__(self, ref_model, *args, **kwargs):
         self.ref_model = ref_model
         kwargs['ref_model'] = ref_model
@@ -312,28 +413,42 @@ class ReferenceField(IntField):
         args.insert(0, ref_model)
         IntField.__init__(self, *args, **kwargs)
     
-    def set_value(self, value):
+    def __get__(self, inst, owner):
+        if inst is None:
+            return self
+        value = inst._values[self.slot]
+        if value is DEFERRED:
+            value = inst.load_deferred(self.name)
+        if value == None:
+            return None
+        if inst._cache:
+            related = inst._cache.get(self.name)
+            if related is not None and related.primary == value:
+                return related
+        return self.ref_model.get(value)
+        
+    def __set__(self, inst, value):
+        IntField.__set__(self, inst, value)
+        if inst._cache:
+            inst._cache.pop(self.name, None)
+    
+    def write_value(self, value):
         if value.__class__ is self.ref_model:
             value = value.primary
-        IntField.set_value(self, value)
-    
-    def get_value(self):
-        model = self.ref_model
-        if self._value == None:
-            return None
-        return model.get(self._value)
+        return IntField.write_value(self, value)
 
        
 class ReferenceManyField(object):
     """
     This is the object that automatically selects a list
-    of objects that Reference this table.
+    of objects that Reference this table. Each model instance
+    keeps its own Results in its cache.
     """
 
     model = None
+    name = None
     ref_field = None
     many_field = None
-    _value = None
   
   
     def __init__(self, ref_table, *args, **kwargs):
@@ -342,17 +457,20 @@ class ReferenceManyField(object):
         self.args = args
         self.kwargs = kwargs
         
-    @property
-    def value(self):
+    def __get__(self, inst, owner):
+        if inst is None:
+            return self
+        cache = inst.get_cache()
+        if self.name not in cache:
+            cache[self.name] = self.get_results(inst)
+        return cache[self.name]
+        
+    def get_results(self, inst):
         """
-        Retrieves the list of results from the joined table.
+        Builds the (lazy) Results for one model instance.
         """
-        if not self._value:
-            self.get_foreign()
-            self._value = self.ref_table.where(
-                { self.ref_field:self.model.primary }
-            )
-        return self._value
+        self.get_foreign()
+        return self.ref_table.where({ self.ref_field:inst.primary })
   
     def get_foreign(self):
         """
@@ -360,11 +478,12 @@ class ReferenceManyField(object):
         retrieve the local reference and the foreign reference
         attributes.
         """
-        table_instance = self.ref_table()
-        for field in table_instance.fields():
-            attr = object.__getattribute__(table_instance, field)
+        if self.ref_field:
+            return
+        for field in self.ref_table.fields():
+            attr = getattr(self.ref_table, field)
             if type(attr) is ReferenceField: 
-                if type(self.model) == attr.ref_model:
+                if self.model == attr.ref_model:
                     self.ref_field = field
                     break
                 
@@ -382,23 +501,21 @@ class ReferenceManyToManyField(ReferenceManyField):
         kwargs['join_table'] = join_table
         ReferenceManyField.__init__(self, ref_table, *args, **kwargs)
         
-    @property
-    def value(self):
-        if not self._value:
-            self.get_foreign()
-            self._value = self.join_table.where({
-                self.ref_field: self.model.primary,
-                self.join_table.get_primary(): self.join_field
-            })
-        return self._value
+    def get_results(self, inst):
+        self.get_foreign()
+        return self.join_table.where({
+            self.ref_field: inst.primary,
+            self.join_table.get_primary(): self.join_field
+        })
             
     def get_foreign(self):
+        if self.ref_field and self.join_field:
+            return
         join_tables = {}
-        table_instance = self.ref_table()
-        for field in table_instance.fields():
-            attr = object.__getattribute__(table_instance, field)
+        for field in self.ref_table.fields():
+            attr = getattr(self.ref_table, field)
             if type(attr) is ReferenceField:
-                if type(self.model) == attr.ref_model:
+                if self.model == attr.ref_model:
                     self.ref_field = attr
                 elif self.join_table:
                     if attr.ref_model == self.join_table:
@@ -411,3 +528,56 @@ class ReferenceManyToManyField(ReferenceManyField):
             raise Exception('Could not find / limit to one ReferenceField.')
         self.join_table = join_tables.keys()[0]
         self.join_field = join_tables.values()[0]
+
+class Index(object):
+    """
+    A composite (or otherwise named) index, declared in a model's
+    Meta.indexes. Columns are field names, or (field name, prefix
+    length) pairs for text columns:
+
+        class Meta:
+            indexes = [
+                Index('city', 'created'),
+                Index(('name', 10), 'email', unique=True, name='contact')
+            ]
+
+    Without a name, the index is named after its columns.
+    """
+    def __init__(self, *columns, **kwargs):
+        for key in kwargs:
+            if key not in ['name', 'unique']:
+                raise TypeError('Unknown index option %s' % key)
+        if not columns:
+            raise ValueError('An Index needs at least one column.')
+        self.columns = []
+        for column in columns:
+            if type(column) in types.StringTypes:
+                column = (column, None)
+            self.columns.append(tuple(column))
+        self.unique = kwargs.get('unique', False)
+        self.name = kwargs.get('name') or \
+            u'_'.join([column for column, length in self.columns])
+
+def compress_value(data, threshold=COMPRESS_THRESHOLD):
+    """
+    Returns the bytes for a compressed column: a header byte, then
+    the data -- zlib compressed if it's at least threshold bytes
+    and that actually makes it smaller.
+    """
+    if len(data) >= threshold:
+        compressed = zlib.compress(data)
+        if len(compressed) < len(data):
+            return ZLIB + compressed
+    return STORED + data
+    
+def decompress_value(value):
+    """
+    Reverses compress_value().
+    """
+    value = str(value)
+    header, data = value[:1], value[1:]
+    if header == ZLIB:
+        return zlib.decompress(data)
+    if header == STORED:
+        return data
+    raise ValueError('Unknown compression header %r.' % header)
@@ -5,34 +5,79 @@ Josh Marshall 2010
 This file contains the Model class.
 """
 
-from Norm.fields import Field, PrimaryField, ReferenceManyField
+from Norm.fields import Field, PrimaryField, ReferenceManyField, DEFERRED
+from Norm.fields import TimestampField
 from Norm.connection import connection
-from Norm.results import Results
+from Norm.results import Results, build_instance, chunked, IN_CHUNK
+from Norm.session import current_session
+from Norm.cache import query_cache
 import types
+import time
+import copy
 import logging
 
+# Every Model subclass with a PrimaryField, by table name.
+MODELS = {}
+
+# The Meta options for the table itself, and their defaults.
+TABLE_OPTIONS = {
+    'engine': None,
+    'row_format': None,
+    'key_block_size': None,
+    'partition': None,
+    'partition_days': 1,
+    'partition_ahead': 3
+}
+
+ROW_FORMATS = ['DEFAULT', 'DYNAMIC', 'FIXED', 'COMPRESSED', 'REDUNDANT', 
+    'COMPACT']
+
+class ModelType(type):
+    """
+    Sets up each Model class once, as it's created -- finding its
+    Fields, primary and relations, and compiling its SQL statements
+    (see Model.parse_attributes()). Fields assigned to the class
+    later on, like a ReferenceManyField back to a model defined
+    further down, set it up again.
+    """
+    def __init__(cls, name, bases, attrs):
+        type.__init__(cls, name, bases, attrs)
+        cls.parse_attributes()
+        if cls._primary is not None:
+            MODELS[cls.table()] = cls
+            
+    def __setattr__(cls, name, value):
+        type.__setattr__(cls, name, value)
+        if isinstance(value, (Field, ReferenceManyField)):
+            cls.parse_attributes()
+
 class Model(object):
     """
     The Model class is designed to simplify row -> model -> row logic
     without crimping the speed benefit of going with a low-level
     interface like MySQLdb. Whether it succeeds... we'll see. :)
+    
+    The Fields stay on the class. Each instance just holds a list
+    of raw column values (_values), a bitmask of the changed ones
+    (_dirty), and a cache dict for related objects that is only
+    created when something needs it.
     """
+    __metaclass__ = ModelType
+    __slots__ = ('_values', '_dirty', '_cache', '_retrieved', '__weakref__')
+    
     def __init__(self, **kwargs):
         """
         Checks the model at instance time. If there's no PrimaryField,
         it throws an Assertion error. (Will be better later.)
-        It then ensures that each Model instance has its own
-        Fields for values.
+        It then gives the instance the default column values.
         """
         assert self.__class__.get_primary() != None
-        for field in self.fields()+self.tables():
-            value = object.__getattribute__(self, field)
-            instance = value.__class__(*value.args, **value.kwargs)
-            instance.model = self
-            object.__setattr__(self, field, instance)
+        self._values = list(self.defaults())
+        self._dirty = 0
+        self._cache = None
             
         for key, val in kwargs.iteritems():
-            self.__setattr__(key, val)
+            setattr(self, key, val)
             
         self._retrieved = False
             
@@ -42,8 +87,15 @@ class Model(object):
         Wrapper for the Results.where() method
         """
         results = Results(cls)
-        return results.where(limiter)   
-                
+        return results.where(limiter)
+
+    @classmethod
+    def where_any(cls, *limiters):
+        """
+        Wrapper for the Results.where_any() method
+        """
+        return Results(cls).where_any(*limiters)
+
     @classmethod
     def all(cls):
         """
@@ -59,6 +111,14 @@ class Model(object):
         results = cls.where(limiter)
         return results.__iter__()
         
+    @classmethod
+    def iter_chunks(cls, page_size=1000, limiter=None, key=None):
+        """
+        Wrapper for the Results.paginate_by() method -- yields
+        lists of up to page_size instances, seeking on the primary.
+        """
+        return cls.where(limiter).paginate_by(key, page_size)
+        
     @classmethod
     def fetch_one(cls, limiter=None):
         """
@@ -69,42 +129,159 @@ class Model(object):
     @classmethod
     def get(cls, id_value):
         """
-        Simple grab for a single primary value
+        Simple grab for a single primary value. If a Session
+        is active and already has the instance, no query is run.
         """
         primary = cls.get_primary()
         if isinstance(id_value, cls):
             id_value = getattr(id_value, primary)
-        return cls.fetch_one({ primary: id_value })
+        id_value = getattr(cls, primary).write_value(id_value)
+        session = current_session()
+        if session is not None:
+            instance = session.get(cls, id_value)
+            if instance is not None:
+                return instance
+        if not connection.connected:
+            raise Exception('Not connected to the database.')
+        cursor = connection.execute(cls._sql['get'], (id_value,))
+        row = cursor.fetchone()
+        connection.release_cursor(cursor)
+        if row is None:
+            return None
+        return build_instance(cls, cls._fields, row,
+            cls.row_factory(cls._fields), checked=True)
+
+    @classmethod
+    def get_many(cls, id_values, as_dict=False, missing=None):
+        """
+        get() for a list of primary values, with one IN (...) query
+        per chunk of ids instead of one query per id. Ids the current
+        Session already has aren't queried. Returns the instances in
+        the order given (None where there's no row), or a dict of
+        id to instance if as_dict is set. If a missing list is passed,
+        the ids with no row are added to it.
+        """
+        primary = cls.get_primary()
+        primary_field = getattr(cls, primary)
+        ids = []
+        for id_value in id_values:
+            if isinstance(id_value, cls):
+                id_value = getattr(id_value, primary)
+            ids.append(primary_field.write_value(id_value))
+        found = {}
+        session = current_session()
+        wanted = []
+        for id_value in ids:
+            if id_value in found:
+                continue
+            instance = None
+            if session is not None:
+                instance = session.get(cls, id_value)
+            # None marks an id as seen, and stays if there's no row.
+            found[id_value] = instance
+            if instance is None:
+                wanted.append(id_value)
+        if wanted:
+            if not connection.connected:
+                raise Exception('Not connected to the database.')
+            factory = cls.row_factory(cls._fields)
+            primary_index = cls._fields.index(primary)
+            for chunk in chunked(wanted, IN_CHUNK):
+                sql = u'%s WHERE %s.%s IN (%s);' % (cls._sql['select'],
+                    cls.table(), primary_field.name,
+                    u', '.join([primary_field.format] * len(chunk)))
+                cursor = connection.execute(sql, tuple(chunk))
+                for row in cursor.fetchall():
+                    found[row[primary_index]] = build_instance(cls,
+                        cls._fields, row, factory, checked=True)
+                connection.release_cursor(cursor)
+        if missing is not None:
+            missing.extend([id_value for id_value in wanted
+                if found[id_value] is None])
+        if as_dict:
+            return dict([(id_value, instance)
+                for id_value, instance in found.iteritems()
+                if instance is not None])
+        return [found[id_value] for id_value in ids]
+
+    def get_raw(self, field):
+        """
+        Returns the raw column value of a field, as it goes to
+        (or came from) the table.
+        """
+        return self._values[getattr(self.__class__, field).slot]
         
-    def __getattribute__(self, attr_k):
+    def set_raw(self, field, value):
         """
-        This just returns the value of a Field, instead of 
-        the Field itself. Probably not the cleanest / best
-        way to do it...
+        Sets the raw column value of a field, without marking it
+        as changed.
         """
-        # Getting the value of the field
-        attr = object.__getattribute__(self, attr_k)
-        attr_type = type(attr)
-        if issubclass(attr_type, Field) or \
-            issubclass(attr_type, ReferenceManyField):
-            return attr.value
-        else:
-            return attr
-            
-    def __setattr__(self, attr_k, val):
-        """
-        Same as __getattribute__, this sets the value of a 
-        Field instead of changing the actual Model attribute.
-        """
-        # Dynamically setting the value of the Field
-        try:
-            attr = object.__getattribute__(self, attr_k)
-        except AttributeError:
-            attr = None
-        if issubclass(attr.__class__, Field):
-            attr.value = val
-        else:
-            return object.__setattr__(self, attr_k, val)
+        self._values[getattr(self.__class__, field).slot] = value
+        
+    def get_cache(self):
+        """
+        The per-instance dict for related objects.
+        """
+        if self._cache is None:
+            self._cache = {}
+        return self._cache
+        
+    def __getstate__(self):
+        """
+        Pickles the column values and flags. The cache of related
+        objects is left behind and rebuilt as needed.
+        """
+        return (self._values, self._dirty, self._retrieved)
+        
+    def __setstate__(self, state):
+        self._values, self._dirty, self._retrieved = state
+        self._cache = None
+        
+    def load_deferred(self, field):
+        """
+        Loads a field that Results.only() / defer() left out, and
+        returns its raw value. Every other instance from the same
+        Results that's still missing it is loaded in the same
+        query (or a few, for long lists).
+        """
+        if not connection.connected:
+            raise Exception('Not connected to the database.')
+        cls = self.__class__
+        slot = getattr(cls, field).slot
+        primary_k = cls.get_primary()
+        primary_slot = getattr(cls, primary_k).slot
+        instances = {self._values[primary_slot]: self}
+        group = None
+        if self._cache:
+            group = self._cache.get('_deferred')
+        if group is not None:
+            for instance in group.values():
+                if instance._values[slot] is DEFERRED:
+                    instances[instance._values[primary_slot]] = instance
+        for chunk in chunked(instances.keys(), IN_CHUNK):
+            sql = u'SELECT %s, %s FROM %s WHERE %s IN (%s);' % (
+                primary_k, field, cls.table(), primary_k,
+                u', '.join([u'%s'] * len(chunk)))
+            cursor = connection.execute(sql, tuple(chunk))
+            for primary, value in cursor.fetchall():
+                instances[primary]._values[slot] = value
+            connection.release_cursor(cursor)
+        for instance in instances.values():
+            if instance._values[slot] is DEFERRED:
+                # The row is gone.
+                instance._values[slot] = None
+        return self._values[slot]
+        
+    def updated_fields(self):
+        """
+        Returns the names of the fields changed since the instance
+        was loaded or last written.
+        """
+        dirty = self._dirty
+        if not dirty:
+            return []
+        return [field for field in self.fields() 
+            if dirty & (1 << getattr(self.__class__, field).slot)]
             
     @classmethod
     def fields(cls):
@@ -112,8 +289,6 @@ class Model(object):
         A class method that returns all the attributes which
         are Fields.
         """
-        if not hasattr(cls, '_fields'):
-            cls.parse_attributes()
         return cls._fields
         
     @classmethod
@@ -122,26 +297,169 @@ class Model(object):
         A class method that returns all the attributes which 
         are ReferenceManyField.
         """
-        if not hasattr(cls, '_tables'):
-            cls.parse_attributes()
         return cls._tables
         
     @classmethod
     def parse_attributes(cls):
         """
-        Kludgy way of determining fields and tables (ReferenceManyField)
+        Determines the fields, tables (ReferenceManyField) and primary,
+        and compiles the SQL statements. ModelType runs this when the
+        class is created, so none of it happens per query.
         """
-        cls._fields = []
-        cls._tables = []
+        fields = []
+        tables = []
+        primary = None
+        for cached in ['_defaults', '_factories', '_update_sql']:
+            if cached in cls.__dict__:
+                delattr(cls, cached)
         for attr_k in dir(cls):
             try:
-                attr = object.__getattribute__(cls, attr_k)
+                attr = getattr(cls, attr_k)
             except AttributeError:
                 continue
-            if issubclass(attr.__class__, ReferenceManyField):
-                cls._tables.append(attr_k)
-            elif issubclass(attr.__class__, Field):
-                cls._fields.append(attr_k)
+            if isinstance(attr, (Field, ReferenceManyField)) and \
+                attr.model not in [None, cls]:
+                # Inherited from (or shared with) another model, which
+                # keeps its own model, name and slot on the original.
+                attr = copy.copy(attr)
+                type.__setattr__(cls, attr_k, attr)
+            if isinstance(attr, ReferenceManyField):
+                attr.model = cls
+                attr.name = attr_k
+                tables.append(attr_k)
+            elif isinstance(attr, Field):
+                attr.model = cls
+                attr.name = attr_k
+                attr.slot = len(fields)
+                fields.append(attr_k)
+                if type(attr) is PrimaryField and primary is None:
+                    primary = attr_k
+        cls._fields = fields
+        cls._tables = tables
+        cls._primary = primary
+        # Part of every query shape on the model, so statements built
+        # for the old fields are never reused from the SQL_CACHE.
+        cls._version = cls.__dict__.get('_version', 0) + 1
+        if primary is not None:
+            cls.compile_sql()
+            cls._options = cls.parse_options()
+            cls._indexes = cls.parse_indexes()
+        for name in tables:
+            # Finding the ReferenceField on the other side now
+            # rather than on first use.
+            getattr(cls, name).get_foreign()
+            
+    @classmethod
+    def compile_sql(cls):
+        """
+        Builds the parameterized statements used by get(), insert(),
+        update() and delete(), and the base SELECT for Results, so
+        those only have to bind values.
+        """
+        table = cls.table()
+        primary = getattr(cls, cls._primary)
+        where = u' WHERE %s.%s = %s LIMIT 1;' % (table, primary.name, 
+            primary.format)
+        columns = u', '.join([u'%s.%s' % (table, f) for f in cls._fields])
+        select = u'SELECT %s FROM %s' % (columns, table)
+        insert_fields = [getattr(cls, f) for f in cls._fields 
+            if not getattr(cls, f).auto_value]
+        # The columns save() writes, as slots and as a bitmask.
+        cls._insert_slots = [field.slot for field in insert_fields]
+        cls._update_mask = 0
+        for field in insert_fields:
+            cls._update_mask |= 1 << field.slot
+        cls._sql = {
+            'select': select,
+            'get': select + where,
+            'insert': u'INSERT INTO %s ( %s ) VALUES( %s );' % (table,
+                u', '.join([field.name for field in insert_fields]),
+                u', '.join([field.format for field in insert_fields])),
+            # The SET clause is filled in by update_sql().
+            'update': u'UPDATE %s SET %%s' % table + where.replace('%', '%%'),
+            'delete': u'DELETE FROM %s' % table + where
+        }
+        # The UPDATE for each combination of changed fields, as
+        # they come up.
+        cls._update_sql = {}
+        
+    @classmethod
+    def update_sql(cls, mask):
+        """
+        Returns the UPDATE-by-primary statement for the fields
+        in the dirty bitmask, and the slots to bind in order.
+        """
+        if mask not in cls._update_sql:
+            sets = []
+            slots = []
+            for field in cls._fields:
+                attr = getattr(cls, field)
+                if mask & (1 << attr.slot):
+                    sets.append(u'%s = %s' % (field, attr.format))
+                    slots.append(attr.slot)
+            cls._update_sql[mask] = (cls._sql['update'] % u', '.join(sets), 
+                slots)
+        return cls._update_sql[mask]
+        
+    @classmethod
+    def defaults(cls):
+        """
+        Returns the raw default value for every field, in slot order.
+        """
+        if '_defaults' not in cls.__dict__:
+            cls._defaults = [getattr(cls, field)._value
+                for field in cls.fields()]
+        return cls._defaults
+        
+    @classmethod
+    def row_factory(cls, columns):
+        """
+        Returns a function that builds a retrieved instance straight
+        from a row (with values in the order of columns), going
+        through __new__ rather than __init__. It's only put together
+        once per column order, and kept on the class.
+        """
+        columns = tuple(columns)
+        if '_factories' not in cls.__dict__:
+            cls._factories = {}
+        if columns in cls._factories:
+            return cls._factories[columns]
+        cls.get_primary()
+        fields = cls.fields()
+        size = len(fields)
+        new = object.__new__
+        
+        if columns[:size] == tuple(fields):
+            def factory(row):
+                """ Builds an instance of the model from a row. """
+                obj = new(cls)
+                obj._values = list(row[:size])
+                obj._dirty = 0
+                obj._cache = None
+                obj._retrieved = True
+                return obj
+        else:
+            # Columns that aren't in the row are loaded when they're
+            # first read (see load_deferred()).
+            plan = []
+            for i in range(size):
+                if fields[i] in columns:
+                    plan.append(columns.index(fields[i]))
+                else:
+                    plan.append(None)
+                    
+            def factory(row):
+                """ Builds an instance of the model from a row. """
+                obj = new(cls)
+                obj._values = [index is None and DEFERRED or row[index]
+                    for index in plan]
+                obj._dirty = 0
+                obj._cache = None
+                obj._retrieved = True
+                return obj
+            
+        cls._factories[columns] = factory
+        return factory
         
     @classmethod
     def table(cls):
@@ -158,45 +476,232 @@ class Model(object):
         if not connection.connected:
             raise Exception('Not connected to the database.')
         cursor = connection.execute(cls.create_table_sql())
-        cursor.close()
+        connection.release_cursor(cursor)
+        query_cache.invalidate(cls.table())
         
     @classmethod
-    def create_table_sql(cls):
+    def create_table_sql(cls, now=None):
         """
-        Generates the SQL that is used to create the table.
+        Generates the SQL that is used to create the table. A table
+        partitioned by Meta.partition starts with partitions for the
+        current interval (as of now) and Meta.partition_ahead more.
         """
+        options = cls._options
+        partition = options['partition']
         sql = u'CREATE TABLE IF NOT EXISTS %s (\n' % cls.table()
         rows = []
-        indexes = {}
-        unique_indexes = {}
         for field_name in cls.fields():
-            field = object.__getattribute__(cls, field_name)
-            params = field.create_syntax()
+            field = getattr(cls, field_name)
+            if partition and field_name == cls._primary:
+                params = field.create_syntax(inline_key=False)
+            else:
+                params = field.create_syntax()
             row = u'\t%s %s' % (field_name, params)
             rows.append(row)
-            if hasattr(field, 'index') and field.index:
-                if hasattr(field, 'unique') and field.unique:
-                    unique_indexes[field_name] = field.index
-                else:
-                    indexes[field_name] = field.index
-        index_strings = []
-        unique_index_strings = []
-        for i_dict, i_strings, i_name in [
-            (indexes, index_strings, 'INDEX'),
-            (unique_indexes, unique_index_strings, 'UNIQUE KEY')
-        ]:
-            for field, length in i_dict.iteritems():
-                if type(length) is types.IntType:
+        for kind, name, columns in cls.indexes():
+            if kind == 'PRIMARY KEY' and partition:
+                # Every unique key has to cover the partition column.
+                rows.append(u'\tPRIMARY KEY (%s)' % 
+                    u', '.join([column for column, length in columns]))
+            if kind not in ['INDEX', 'UNIQUE KEY']:
+                # Declared along with the column.
+                continue
+            i_strings = []
+            for field, length in columns:
+                if length is not None:
                     index_string = u'%s(%d)' % (field, length)
                 else:
                     index_string = u'%s' % field
                 i_strings.append(index_string)
-            if len(i_strings) > 0:
-                rows.append(u'\t%s(%s)' % 
-                    (i_name, u', '.join(i_strings))
-                )
-        sql += u'%s\n) DEFAULT CHARSET=UTF8;' % u',\n'.join(rows)
-        return sql
+            rows.append(u'\t%s %s (%s)' % (kind, name, u', '.join(i_strings)))
+        sql += u'%s\n)' % u',\n'.join(rows)
+        if options['engine']:
+            sql += u' ENGINE=%s' % options['engine']
+        if options['row_format']:
+            sql += u' ROW_FORMAT=%s' % options['row_format']
+        if options['key_block_size']:
+            sql += u' KEY_BLOCK_SIZE=%d' % options['key_block_size']
+        sql += u' DEFAULT CHARSET=UTF8'
+        if partition:
+            interval = options['partition_days'] * 86400
+            start = cls.partition_start(now)
+            stop = start + (options['partition_ahead'] + 1) * interval
+            definitions = [u'PARTITION %s VALUES LESS THAN (%d)' % bound
+                for bound in cls.partition_bounds(start, stop)]
+            definitions.append(u'PARTITION pmax VALUES LESS THAN MAXVALUE')
+            sql += u'\nPARTITION BY RANGE (UNIX_TIMESTAMP(%s)) (\n\t%s\n)' % (
+                partition, u',\n\t'.join(definitions))
+        return sql + u';'
+        
+    @classmethod
+    def parse_options(cls):
+        """
+        Reads the table options (engine, row_format, key_block_size
+        and partitioning) from the model's Meta, with the defaults
+        from TABLE_OPTIONS.
+        """
+        meta = getattr(cls, 'Meta', None)
+        options = {}
+        for key, default in TABLE_OPTIONS.iteritems():
+            options[key] = getattr(meta, key, default)
+        if options['row_format'] is not None:
+            options['row_format'] = options['row_format'].upper()
+            if options['row_format'] not in ROW_FORMATS:
+                raise ValueError('Unknown row format %s.' % 
+                    options['row_format'])
+        if options['key_block_size'] not in [None, 1, 2, 4, 8, 16]:
+            raise ValueError('KEY_BLOCK_SIZE must be 1, 2, 4, 8 or 16.')
+        partition = options['partition']
+        if partition is not None:
+            if not isinstance(getattr(cls, partition, None), TimestampField):
+                raise ValueError('%s is not a TimestampField on %s.' % 
+                    (partition, cls.table()))
+            if options['partition_days'] < 1 or \
+                options['partition_ahead'] < 0:
+                raise ValueError('Bad partition_days / partition_ahead.')
+        return options
+        
+    @classmethod
+    def indexes(cls):
+        """
+        Returns the indexes create_table_sql() declares, as
+        (kind, name, [(column, prefix length or None), ...]),
+        starting with the PRIMARY KEY.
+        """
+        return cls._indexes
+        
+    @classmethod
+    def parse_indexes(cls):
+        """
+        Builds the indexes() list: one index for each field with
+        index or unique set (index=N indexes the first N characters),
+        and then the composite ones in Meta.indexes.
+        """
+        primary = cls._primary
+        partition = cls._options['partition']
+        primary_columns = [(primary, None)]
+        if partition:
+            primary_columns.append((partition, None))
+        indexes = [('PRIMARY KEY', u'PRIMARY', primary_columns)]
+        for field_name in cls._fields:
+            field = getattr(cls, field_name)
+            index = getattr(field, 'index', False)
+            unique = getattr(field, 'unique', False)
+            if field_name == primary:
+                continue
+            length = None
+            if type(index) is types.IntType:
+                length = index
+            if index and unique:
+                indexes.append(('UNIQUE KEY', field_name, 
+                    [(field_name, length)]))
+            elif index:
+                indexes.append(('INDEX', field_name, [(field_name, length)]))
+            elif unique:
+                indexes.append(('UNIQUE', field_name, [(field_name, None)]))
+        meta = getattr(cls, 'Meta', None)
+        for index in getattr(meta, 'indexes', []):
+            Results(cls).check_columns(
+                [column for column, length in index.columns])
+            kind = 'INDEX'
+            if index.unique:
+                kind = 'UNIQUE KEY'
+            indexes.append((kind, index.name, index.columns))
+        names = [name for kind, name, columns in indexes]
+        for name in names:
+            if names.count(name) > 1:
+                raise ValueError('Duplicate index name %s on %s.' % 
+                    (name, cls.table()))
+        for kind, name, columns in indexes:
+            if partition and kind in ['UNIQUE', 'UNIQUE KEY'] and \
+                partition not in [column for column, length in columns]:
+                raise ValueError('Unique index %s on %s must include the '
+                    'partition column %s.' % (name, cls.table(), partition))
+        return indexes
+        
+    @classmethod
+    def partition_start(cls, now=None):
+        """
+        The start of the current partition interval, as a UNIX
+        timestamp. Intervals are whole UTC days.
+        """
+        if now is None:
+            now = time.time()
+        interval = cls._options['partition_days'] * 86400
+        return int(now) // interval * interval
+        
+    @classmethod
+    def partition_bounds(cls, start, stop):
+        """
+        The (name, upper bound) of each partition interval from start
+        up to stop, named for the (UTC) day it starts on.
+        """
+        interval = cls._options['partition_days'] * 86400
+        return [(u'p%s' % time.strftime('%Y%m%d', time.gmtime(lower)), 
+            lower + interval) for lower in range(start, stop, interval)]
+        
+    @classmethod
+    def rotate_partitions(cls, keep, now=None):
+        """
+        For a table partitioned on Meta.partition, adds partitions
+        so there are Meta.partition_ahead intervals after the current
+        one, and drops the ones that ended more than keep intervals
+        ago -- throwing their rows away without a slow DELETE. Run
+        it from a daily job. Returns the names of the partitions
+        (added, dropped).
+        """
+        options = cls._options
+        if not options['partition']:
+            raise ValueError('%s is not partitioned.' % cls.table())
+        if not connection.connected:
+            raise Exception('Not connected to the database.')
+        cursor = connection.execute(u'SELECT PARTITION_NAME, '
+            u'PARTITION_DESCRIPTION FROM information_schema.PARTITIONS '
+            u'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s '
+            u'ORDER BY PARTITION_ORDINAL_POSITION;', (cls.table(),))
+        existing = cursor.fetchall()
+        connection.release_cursor(cursor)
+        bounds = {}
+        catch_all = None
+        for name, description in existing:
+            if description == 'MAXVALUE':
+                catch_all = name
+            else:
+                bounds[name] = int(description)
+        interval = options['partition_days'] * 86400
+        start = cls.partition_start(now)
+        stop = start + (options['partition_ahead'] + 1) * interval
+        # New partitions carry on from the last one, so there's no gap.
+        last = start
+        if bounds:
+            last = max(bounds.values())
+        new_bounds = cls.partition_bounds(last, stop)
+        added = [name for name, upper in new_bounds]
+        definitions = [u'PARTITION %s VALUES LESS THAN (%d)' % bound
+            for bound in new_bounds]
+        if definitions and catch_all:
+            definitions.append(u'PARTITION %s VALUES LESS THAN MAXVALUE' % 
+                catch_all)
+            sql = u'ALTER TABLE %s REORGANIZE PARTITION %s INTO (%s);' % (
+                cls.table(), catch_all, u', '.join(definitions))
+            connection.release_cursor(connection.execute(sql))
+        elif definitions:
+            sql = u'ALTER TABLE %s ADD PARTITION (%s);' % (
+                cls.table(), u', '.join(definitions))
+            connection.release_cursor(connection.execute(sql))
+        cutoff = start - keep * interval
+        dropped = [name for name, upper in bounds.iteritems() 
+            if upper <= cutoff]
+        dropped.sort(key=bounds.get)
+        if dropped:
+            sql = u'ALTER TABLE %s DROP PARTITION %s;' % (
+                cls.table(), u', '.join(dropped))
+            connection.release_cursor(connection.execute(sql))
+            query_cache.invalidate(cls.table())
+            session = current_session()
+            if session is not None:
+                session.invalidate(cls)
+        return added, dropped
         
     @classmethod
     def drop_table(cls):
@@ -206,20 +711,15 @@ class Model(object):
         if not connection.connected:
             raise Exception('Not connected to the database.')
         sql = u'DROP TABLE IF EXISTS %s' % cls.table()
-        connection.execute(sql)
+        connection.release_cursor(connection.execute(sql))
+        query_cache.invalidate(cls.table())
      
     @classmethod   
     def get_primary(cls):
         """
-        Hunts for the PrimaryField in the attributes.
-        TODO: Cache this value so it only hunts once.
+        Returns the name of the PrimaryField.
         """
-        if not hasattr(cls, '_primary'):
-            for field in cls.fields():
-                attr = object.__getattribute__(cls, field)
-                if type(attr) is PrimaryField:
-                    cls._primary = field
-                    return field
+        if cls._primary is None:
             raise Exception('No PrimaryField set!')
         return cls._primary
                 
@@ -248,17 +748,21 @@ class Model(object):
         """
         Updates an existing entry in the table.
         """
-        values = {}
-        for field in self.fields():
-            attr = object.__getattribute__(self, field)
-            if not attr.auto_value and attr._updated:
-                values[field] = getattr(self, field)
-                object.__setattr__(attr, '_updated', False)
-        result = self.where({self.__class__.get_primary():self.primary})
-        if len(values) == 0:
+        cls = self.__class__
+        mask = self._dirty & cls._update_mask
+        self.clear_updated()
+        if not mask:
             logging.warning('update() called on model with no changed fields.')
             return None
-        return result.update(values)[0]
+        sql, slots = cls.update_sql(mask)
+        values = [self._values[slot] for slot in slots]
+        values.append(self.get_raw(cls._primary))
+        connection.release_cursor(connection.execute(sql, values))
+        query_cache.invalidate(cls.table())
+        session = current_session()
+        if session is not None:
+            session.invalidate(cls, self.primary)
+            session.add(self)
         
         
     def insert(self):
@@ -268,31 +772,198 @@ class Model(object):
         a dangerous assumption that the PrimaryField is
         using that, so I may need to change this in the future.
         """
-        sql = u'INSERT INTO %s' % self.table()
+        cls = self.__class__
+        values = [self._values[slot] for slot in cls._insert_slots]
+        connection.release_cursor(connection.execute(cls._sql['insert'], 
+            values))
+        query_cache.invalidate(cls.table())
+        self.set_raw(cls.get_primary(), connection.insert_id())
+        self.clear_updated()
+        session = current_session()
+        if session is not None:
+            session.add(self)
+        
+    @classmethod
+    def bulk_insert(cls, instances, chunk_size=1000):
+        """
+        Inserts a list of new instances with multi-row INSERTs, at
+        most chunk_size rows each, and split further so a statement
+        never goes over the server's max_allowed_packet. 
+        
+        Auto incremented primaries are handed out from the first
+        insert id of each statement, which assumes MySQL gives a
+        multi-row INSERT consecutive ids (the default
+        innodb_autoinc_lock_mode does). Afterwards the instances
+        are marked as retrieved, so save() will UPDATE them.
+        """
+        if not connection.connected:
+            raise Exception('Not connected to the database.')
+        primary_k = cls.get_primary()
+        auto_primary = getattr(cls, primary_k).auto_value
         keys = []
-        values = []
-        format_values = []
-        for field in self.fields():
-            attr = object.__getattribute__(self, field)
-            if attr.auto_value:
+        for field in cls.fields():
+            if not getattr(cls, field).auto_value:
+                keys.append(field)
+        session = current_session()
+        for chunk in cls.insert_chunks(keys, instances, chunk_size):
+            first_id = connection.insert_id()
+            for i in range(len(chunk)):
+                if auto_primary:
+                    chunk[i].set_raw(primary_k, first_id + i)
+                chunk[i].clear_updated()
+                chunk[i]._retrieved = True
+                if session is not None:
+                    session.add(chunk[i])
+                
+    @classmethod
+    def bulk_save(cls, instances, chunk_size=1000):
+        """
+        The bulk version of save(). New instances go through
+        bulk_insert(), and changed ones are grouped by which fields
+        changed, each group going out as chunked multi-row UPDATEs
+        by primary (see update_chunks()). Instances with nothing
+        changed are skipped. Like save(), rows deleted in the
+        meantime just aren't updated.
+        """
+        if not connection.connected:
+            raise Exception('Not connected to the database.')
+        primary_k = cls.get_primary()
+        new = []
+        groups = {}
+        for instance in instances:
+            assert isinstance(instance, cls)
+            if not instance._retrieved:
+                new.append(instance)
                 continue
-            keys.append(field)
-            format_values.append(attr.format)
-            values.append(attr._value)
-        keys_str = u'( %s )' % u', '.join(keys)
-        values_str = u'VALUES( %s )' % u', '.join(format_values)
-        sql = '%s %s %s;' % (sql, keys_str, values_str)
-        connection.execute(sql, values)
-        primary_k = self.__class__.get_primary()
-        primary = object.__getattribute__(self, primary_k)
-        primary.value = connection.connection.insert_id()
+            changed = []
+            for field in instance.updated_fields():
+                if not getattr(cls, field).auto_value and field != primary_k:
+                    changed.append(field)
+            if changed:
+                groups.setdefault(tuple(changed), []).append(instance)
+        if new:
+            cls.bulk_insert(new, chunk_size)
+        session = current_session()
+        for changed, group in groups.iteritems():
+            for chunk in cls.update_chunks(changed, group, chunk_size):
+                for instance in chunk:
+                    instance.clear_updated()
+                    if session is not None:
+                        session.invalidate(cls, instance.primary)
+                        session.add(instance)
+                    
+    @classmethod
+    def update_chunks(cls, fields, instances, chunk_size):
+        """
+        Runs UPDATEs of the given fields for a list of instances, as
+        UPDATE ... SET field = CASE primary WHEN ... END ... WHERE
+        primary IN (...), at most chunk_size rows each and split
+        further to stay under max_allowed_packet. Yields each list
+        of instances right after its statement runs.
+        """
+        assert chunk_size > 0
+        primary = getattr(cls, cls.get_primary())
+        attrs = [getattr(cls, field) for field in fields]
+        when = [u' WHEN %s THEN %s' % (primary.format, attr.format)
+            for attr in attrs]
+        max_size = connection.max_allowed_packet() - 1024
+        
+        chunks = [[]]
+        size = 0
+        for instance in instances:
+            key = instance._values[primary.slot]
+            row_values = [instance._values[attr.slot] for attr in attrs]
+            row_size = estimate_size([key] * (len(attrs) + 1) + row_values) \
+                + len(u''.join(when)) + 4
+            if chunks[-1] and (len(chunks[-1]) >= chunk_size or
+                size + row_size > max_size):
+                chunks.append([])
+                size = 0
+            chunks[-1].append((instance, key, row_values))
+            size += row_size
+            
+        for chunk in chunks:
+            if not chunk:
+                continue
+            sets = []
+            values = []
+            for i in range(len(attrs)):
+                sets.append(u'%s = CASE %s%s END' % (attrs[i].name, 
+                    primary.name, when[i] * len(chunk)))
+                for instance, key, row_values in chunk:
+                    values.extend([key, row_values[i]])
+            values.extend([key for instance, key, row_values in chunk])
+            sql = u'UPDATE %s SET %s WHERE %s IN (%s);' % (cls.table(),
+                u', '.join(sets), primary.name, 
+                u', '.join([primary.format] * len(chunk)))
+            connection.release_cursor(connection.execute(sql, values))
+            query_cache.invalidate(cls.table())
+            yield [instance for instance, key, row_values in chunk]
+                
+    @classmethod
+    def insert_chunks(cls, keys, instances, chunk_size):
+        """
+        Runs multi-row INSERTs of the given columns for a list of
+        instances, at most chunk_size rows each, and split further
+        so a statement never goes over the server's
+        max_allowed_packet. Yields each list of instances right
+        after its statement runs (so insert_id() is still good).
+        """
+        assert chunk_size > 0
+        slots = [getattr(cls, field).slot for field in keys]
+        formats = [getattr(cls, field).format for field in keys]
+        row = u'( %s )' % u', '.join(formats)
+        sql = u'INSERT INTO %s ( %s ) VALUES ' % (cls.table(), u', '.join(keys))
+        # Leaving some room for the packet header and rounding.
+        max_size = connection.max_allowed_packet() - len(sql) - 1024
+        
+        # Splitting into chunks of (instance, values) pairs.
+        chunks = [[]]
+        size = 0
+        for instance in instances:
+            assert isinstance(instance, cls)
+            row_values = [instance._values[slot] for slot in slots]
+            row_size = estimate_size(row_values) + len(row) + 2
+            if chunks[-1] and (len(chunks[-1]) >= chunk_size or
+                size + row_size > max_size):
+                chunks.append([])
+                size = 0
+            chunks[-1].append((instance, row_values))
+            size += row_size
+            
+        for chunk in chunks:
+            if not chunk:
+                continue
+            values = []
+            for instance, row_values in chunk:
+                values.extend(row_values)
+            rows = u', '.join([row] * len(chunk))
+            sql_chunk = u'%s%s;' % (sql, rows)
+            connection.release_cursor(connection.execute(sql_chunk, values))
+            query_cache.invalidate(cls.table())
+            yield [instance for instance, row_values in chunk]
+                
+    def clear_updated(self):
+        """
+        Marks every field as unchanged, usually after it's been
+        written to the table.
+        """
+        self._dirty = 0
         
     def delete(self):
         """
         Deletes the object from the MySQL table.
         """
-        result = self.where({self.__class__.get_primary():self.primary})
-        return result.delete()[0]
+        if not connection.connected:
+            raise Exception('Not connected to the database.')
+        cls = self.__class__
+        primary = self.get_raw(cls.get_primary())
+        connection.release_cursor(connection.execute(cls._sql['delete'], 
+            (primary,)))
+        query_cache.invalidate(cls.table())
+        session = current_session()
+        if session is not None:
+            session.invalidate(cls, primary)
         
     def __eq__(self, other):
         """
@@ -309,3 +980,19 @@ class Model(object):
         Inverse of __eq___
         """
         return self.__eq__(other) == False
+        
+def estimate_size(values):
+    """
+    A rough, cautious guess at how many bytes a list of values
+    takes up once escaped, quoted and UTF-8 encoded.
+    """
+    size = 0
+    for value in values:
+        if value is None:
+            size += 4
+        elif isinstance(value, basestring):
+            # Every character could be three bytes and escaped.
+            size += len(value) * 6 + 2
+        else:
+            size += len(str(value)) + 2
+    return size
@@ -5,12 +5,55 @@ Josh Marshall 2010
 This file contains the Results class.
 """
 from Norm.connection import connection
-from Norm.fields import ReferenceField
+from Norm.fields import ReferenceField, ReferenceManyToManyField
+from Norm.session import current_session
+from Norm.cache import LRUCache, RowCursor, query_cache
+from MySQLdb.cursors import SSCursor
+from collections import deque
 import types
+import copy
+import weakref
+import logging
 
 ASCENDING = 'ASC'
 DESCENDING = 'DESC'
 
+# MySQL's way of saying "LIMIT offset, everything".
+MAX_ROWS = 18446744073709551615
+
+# How many parent rows are hydrated at once for prefetch_related(),
+# and how many keys go into a single IN (...) list (where() splits
+# longer ones into a query each, when nothing spans them).
+PREFETCH_BATCH = 1000
+IN_CHUNK = 1000
+
+AGGREGATES = ['count', 'sum', 'avg', 'min', 'max']
+
+# The lookups where() understands, as 'column__lookup' keys.
+OPERATORS = {
+    'exact': u'=',
+    'ne': u'!=',
+    'gt': u'>',
+    'gte': u'>=',
+    'lt': u'<',
+    'lte': u'<=',
+    'in': u'IN',
+    'range': u'BETWEEN',
+    'startswith': u'LIKE',
+    'isnull': u'IS NULL'
+}
+
+# In verbose mode (or with the Norm logger at DEBUG), sorts that no
+# index covers are warned about on tables with more rows than this.
+FILESORT_ROWS = 10000
+
+# The server's row count estimates, by table (see estimate_rows()).
+ROW_ESTIMATES = {}
+
+# Finished statements by query shape (see Results.get_shape()),
+# shared by every Results. SQL_CACHE.stats() shows the hit rate.
+SQL_CACHE = LRUCache(max_size=500)
+
 class Results(object):
     """
     This is the class that collects the query modifiers, generates
@@ -20,14 +63,63 @@ class Results(object):
     def __init__(self, model):
         self.model = model
         self.fields = self.model.fields()
-        self.values = []
+        # Bound values for an UPDATE's SET clause.
+        self.set_values = []
+        self.where_values = []
+        # Bound values for the LIMIT clause.
+        self.limit_values = []
+        # {(column, lookup): value} conditions, all ANDed together.
         self.where_fields = {}
-        self.order_fields = {}
+        # Lists of condition dicts from where_any(), ORed together.
+        self.or_groups = []
+        # (column, direction) pairs, in the order they sort by.
+        self.order_fields = []
+        self.group_fields = []
         self.current_row = 0
         self.tables = []
+        # Each Results owns its cursor (and the Connection it came
+        # from) until close() hands it back.
+        self.db = None
         self.cursor = None
         self.operation = None
         self.slice = slice(None, None, None)
+        # Whether get_sql() could put the slice in the LIMIT clause.
+        # Negative indexes can't be, so those still scroll().
+        self.server_slice = True
+        # A (column, value) to start after, for paginate_by().
+        self.seek = None
+        # Set by values() / values_list() -- the columns to select,
+        # their read conversions, and 'dict', 'tuple' or 'flat'.
+        self.projection = None
+        self.converters = []
+        self.projection_type = None
+        # Set by only() / defer() -- the columns actually selected,
+        # the rest being loaded when they're first read.
+        self.selected = None
+        # The instances hydrated with deferred columns, by primary,
+        # so reading one loads the column for all of them.
+        self.deferred = None
+        # Model.row_factory() for the selected columns, looked up
+        # on first use.
+        self.factory = None
+        # Set by stream() -- rows are read from the server in
+        # batches of this size instead of all at once.
+        self.batch_size = None
+        self.batch = deque()
+        # Set by cached() -- how long the rows are kept in the
+        # query cache.
+        self.cache_ttl = None
+        # ReferenceField paths loaded in the same query, parents
+        # always ahead of their children.
+        self.related = []
+        self.joins = []
+        # ReferenceManyFields filled in a batch at a time.
+        self.prefetch = []
+        # Hydrated instances waiting to be handed out by next().
+        self.pending = deque()
+        # Set when the instances were loaded some other way (like
+        # prefetch_related()), so there is no query to run.
+        self.instances = None
     
     def where(self, limiter=None):
         """
@@ -35,6 +127,11 @@ class Results(object):
         and adds them to the self.where_fields dict, normalizing
         values as necessary.
         
+        Keys can end in a lookup (see OPERATORS), like 'age__gte',
+        'id__in' (a list), 'created__range' (a pair), 'name__startswith'
+        or 'city__isnull' (True or False). A key without one is an
+        exact match, and an exact match on None is IS NULL.
+        
         TODO: Add JOINs.
         """
         if not limiter:
@@ -42,32 +139,88 @@ class Results(object):
         from Norm.model import Model
         if issubclass(type(limiter), Model):
             limiter = get_model_limiter(limiter)
-        self.where_fields = {}
+        self.instances = None
+        self.where_fields = self.parse_limiter(limiter)
+        return self
+        
+    def where_any(self, *limiters):
+        """
+        Adds a group of limiter dicts (like where() takes) where
+        any one of them has to match. The group is ANDed with the
+        rest of the conditions.
+        """
+        self.instances = None
+        self.or_groups.append([self.parse_limiter(l) for l in limiters])
+        return self
+        
+    def parse_limiter(self, limiter):
+        """
+        Turns a limiter dict into {(column, lookup): value} conditions.
+        """
+        conditions = {}
         for column, value in limiter.iteritems():
-            # The key is the attribute name, the column is either
-            # the ReferenceField or the 'table.column' string, and
-            # the value is either the ReferenceField or the formatted
-            # value from the appropriate model.
+            # The key is the attribute name (and lookup), the column
+            # is either the ReferenceField or the 'table.column'
+            # string, and the value is either the ReferenceField or
+            # the formatted value from the appropriate model.
+            operator = 'exact'
             if type(column) is not ReferenceField:
-                key = column
-                column = '%s.%s' % (self.model.table(), column)
+                if '__' in column:
+                    column, operator = column.rsplit('__', 1)
+                if operator not in OPERATORS:
+                    raise ValueError('Unknown lookup %s.' % operator)
+                self.check_columns([column])
+                attr = getattr(self.model, column)
+                column = u'%s.%s' % (self.model.table(), column)
             else:
-                key = column.model.get_primary()
-            if type(value) is not ReferenceField:
+                attr = column
+            if isinstance(value, Results):
+                # A subquery, run by the server as part of this one.
+                if operator != 'in':
+                    raise ValueError('Only in lookups take a Results.')
+                value = value.clone()
+            elif type(value) is not ReferenceField:
                 # Formatting value appropriately...
-                attr = object.__getattribute__(self.model, key)
-                attr.value = value
-                value = attr._value
-            self.where_fields[column] = value
+                value = format_lookup(attr, operator, value)
+            conditions[(column, operator)] = value
+        return conditions
+        
+    def check_columns(self, columns):
+        """
+        Raises ValueError for any column that isn't a field on
+        the model.
+        """
+        for column in columns:
+            if column not in self.fields:
+                raise ValueError('%s is not a field on %s.' % 
+                    (column, self.model.table()))
+                    
+    def where_in(self, column, values):
+        """
+        Adds an IN (...) condition on a column, for a list of values
+        that are already formatted (or a Results to use as a subquery).
+        """
+        self.instances = None
+        column = u'%s.%s' % (self.model.table(), column)
+        if not isinstance(values, Results):
+            values = list(values)
+        self.where_fields[(column, 'in')] = values
         return self
         
     def order(self, column, direction=ASCENDING):
         """
-        Simply stores a columns order into the order
-        field dict. Must be 'ASC' or 'DESC'.
+        Adds a column to sort by, after any that were added before.
+        Must be 'ASC' or 'DESC'. Ordering on a column again just
+        changes its direction.
         """
         assert direction in [ASCENDING, DESCENDING]
-        self.order_fields[column] = direction
+        self.instances = None
+        for i in range(len(self.order_fields)):
+            if self.order_fields[i][0] == column:
+                self.order_fields[i] = (column, direction)
+                break
+        else:
+            self.order_fields.append((column, direction))
         return self
         
     def reverse(self):
@@ -78,16 +231,173 @@ class Results(object):
         """
         if len(self.order_fields) == 0:
             # Only auto-reversing primary if nothing else specified
-            if not self.order_fields.has_key(self.model.get_primary()):
-                # Putting it in so it will be reversed.
-                self.order_fields[self.model.get_primary()] = ASCENDING
-        for key, value in self.order_fields.iteritems():
-            if value == ASCENDING:
-                self.order_fields[key] = DESCENDING
-            else:
-                self.order_fields[key] = ASCENDING
+            # Putting it in so it will be reversed.
+            self.order_fields = [(self.model.get_primary(), ASCENDING)]
+        flipped = {ASCENDING: DESCENDING, DESCENDING: ASCENDING}
+        self.order_fields = [(key, flipped[value]) 
+            for key, value in self.order_fields]
+        if self.instances is not None:
+            self.instances.reverse()
+        return self
+        
+    def stream(self, batch_size=1000):
+        """
+        Switches to a server-side (unbuffered) cursor, so rows are
+        pulled batch_size at a time with fetchmany() instead of the
+        whole result set landing in memory first. The stream gets a
+        Connection to itself, so other queries can run while it is
+        being read. Slices are pushed into the LIMIT clause, and
+        negative indexes aren't supported.
+        """
+        assert batch_size > 0
+        self.batch_size = batch_size
         return self
         
+    def values(self, *columns):
+        """
+        Selects just the given columns (or all of them) and yields
+        a dict per row instead of a model instance. Each value goes
+        through its field's read conversion, but no Model or Field
+        objects are built.
+        """
+        return self.project(columns, 'dict')
+        
+    def values_list(self, *columns, **kwargs):
+        """
+        Like values(), but yields tuples -- or, with flat=True and
+        a single column, just the value.
+        """
+        if kwargs.get('flat'):
+            if len(columns) != 1:
+                raise ValueError('flat=True needs exactly one column.')
+            return self.project(columns, 'flat')
+        return self.project(columns, 'tuple')
+        
+    def project(self, columns, projection_type):
+        """
+        Sets up the values() / values_list() projection.
+        """
+        if not columns:
+            columns = self.fields
+        self.check_columns(columns)
+        self.projection = list(columns)
+        self.converters = [getattr(self.model, c).read_value
+            for c in columns]
+        self.projection_type = projection_type
+        self.instances = None
+        self.operation = None
+        return self
+        
+    def only(self, *columns):
+        """
+        Selects just the given columns (and the primary) when
+        building instances. The others are loaded when they're first
+        read, for every instance from these Results at once.
+        """
+        self.check_columns(columns)
+        primary = self.model.get_primary()
+        self.select_columns([f for f in self.fields 
+            if f == primary or f in columns])
+        return self
+        
+    def defer(self, *columns):
+        """
+        The opposite of only() -- leaves the given columns out of
+        the SELECT, to be loaded when they're first read.
+        """
+        self.check_columns(columns)
+        if self.model.get_primary() in columns:
+            raise ValueError('The primary can not be deferred.')
+        self.select_columns([f for f in self.selected or self.fields 
+            if f not in columns])
+        return self
+        
+    def select_columns(self, columns):
+        """
+        Sets the columns only() / defer() select.
+        """
+        if columns == self.fields:
+            columns = None
+        self.selected = columns
+        self.factory = None
+        self.instances = None
+        
+    def cached(self, ttl=None):
+        """
+        Reads the rows through the query cache (Norm.cache.query_cache),
+        which keeps them for ttl seconds (or its default ttl) or until
+        something writes to one of the tables involved. Streams aren't
+        cached.
+        """
+        if ttl is None:
+            ttl = query_cache.ttl
+        self.cache_ttl = ttl
+        return self
+        
+    def select_related(self, *paths):
+        """
+        Loads the models behind ReferenceFields in the same query,
+        using LEFT JOINs, so touching them later doesn't run a query
+        per row. Paths follow references with '__', like
+        'city__state' (which loads the city as well).
+        """
+        for path in paths:
+            parts = path.split('__')
+            for i in range(1, len(parts) + 1):
+                sub_path = '__'.join(parts[:i])
+                if sub_path not in self.related:
+                    self.related.append(sub_path)
+        return self
+        
+    def prefetch_related(self, *names):
+        """
+        Fills ReferenceManyFields (and ReferenceManyToManyFields)
+        for a whole batch of rows at once, with one IN (...) query
+        per relation instead of one query per row.
+        """
+        for name in names:
+            attr = None
+            if name in self.model.tables():
+                attr = getattr(self.model, name)
+            if attr is None:
+                raise ValueError('%s is not a ReferenceManyField on %s.' % 
+                    (name, self.model.table()))
+            if name not in self.prefetch:
+                self.prefetch.append(name)
+        return self
+        
+    def get_joins(self):
+        """
+        Resolves the select_related() paths into a list of
+        (path, parent path, field, model) tuples, where a parent
+        path of '' is this model.
+        """
+        joins = []
+        models = {'': self.model}
+        for path in self.related:
+            if '__' in path:
+                parent, field = path.rsplit('__', 1)
+            else:
+                parent, field = '', path
+            parent_model = models[parent]
+            attr = None
+            if field in parent_model.fields():
+                attr = getattr(parent_model, field)
+            if not isinstance(attr, ReferenceField):
+                raise ValueError('%s is not a ReferenceField on %s.' % 
+                    (field, parent_model.table()))
+            models[path] = attr.ref_model
+            joins.append((path, parent, field, attr.ref_model))
+        return joins
+        
+    def get_alias(self, path):
+        """
+        The table alias used for a select_related() path.
+        """
+        if not path:
+            return self.model.table()
+        return u'_%s' % path
+        
     def delete(self):
         """
         This deletes all the entries that match the current conditions.
@@ -104,15 +414,13 @@ class Results(object):
             set_values = {}
         sets = []
         values = []
-        obj = self.model()
         for field, value in set_values.iteritems():
-            setattr(obj, field, value)
-            attr = object.__getattribute__(obj, field)
+            attr = getattr(self.model, field)
             sets.append(u'%s = %s' % (field, attr.format))
-            values.append(attr._value)
+            values.append(attr.write_value(value))
         set_sql = u'SET %s' % u', '.join(sets)
         self.operation = u'UPDATE %s %s' % (self.model.table(), set_sql)
-        self.values = values + self.values
+        self.set_values = values + self.set_values
         return self
         
     def fetch_one(self):
@@ -136,80 +444,501 @@ class Results(object):
     def get_sql(self):
         """
         Parses the values and generates final SQL for execution.
+        The statement is cached by the shape of the query, so for
+        a shape that's been seen before only the values to bind
+        are collected.
         """
-        self.tables = [self.model.table(),]
-        where = u''
-        order = u''
-        limit = u''
+        if self.operation and self.operation.startswith('SELECT'):
+            # Left over from an earlier run, which is rebuilt (with
+            # its ORDER BY) like clone() would.
+            self.operation = None
+        limit, self.limit_values = self.get_limit()
+        shape = self.get_shape(limit)
+        cached = SQL_CACHE.get(shape)
+        if cached is None:
+            sql = self.build_sql(limit)
+            if self.order_fields and self.operation.startswith('SELECT') and \
+                (connection.verbose or 
+                logging.getLogger('Norm').isEnabledFor(logging.DEBUG)):
+                self.check_order()
+            SQL_CACHE.set(shape, 
+                (sql, self.operation, list(self.tables), list(self.joins)))
+            return sql
+        sql, self.operation, tables, joins = cached
+        self.tables = list(tables)
+        self.joins = list(joins)
+        self.where_values = self.get_where_values()
+        return sql
+        
+    def get_shape(self, limit):
+        """
+        Returns a key for everything that goes into the statement
+        except the bound values -- the model's (and joined models')
+        field versions, the columns (not values) that are limited on,
+        the order, the LIMIT form, and so on.
+        """
+        ors = [tuple([get_conditions_shape(conditions) 
+            for conditions in group]) for group in self.or_groups]
+        # The joined models' fields go into the SELECT too.
+        versions = [self.model._version]
+        if self.related:
+            versions.extend([join[3]._version for join in self.get_joins()])
+        return (self.model, tuple(versions), self.operation, 
+            self.projection and tuple(self.projection), 
+            self.selected and tuple(self.selected), tuple(self.related),
+            get_conditions_shape(self.where_fields), 
+            self.seek and self.seek[0], tuple(ors),
+            tuple(self.order_fields), limit)
+            
+    def get_limit(self):
+        """
+        Returns the LIMIT clause for the slice and the values to bind
+        to it, and sets whether the slice is handled on the server.
+        """
+        start = self.slice.start or 0
+        stop = self.slice.stop
+        if self.operation and start > 0:
+            raise ValueError('UPDATE and DELETE can not skip rows.')
+        self.server_slice = start >= 0 and (stop == None or stop >= 0)
+        if self.server_slice:
+            # The offset goes to the server, so skipped rows
+            # are never sent.
+            if stop != None:
+                count = max(stop - start, 0)
+            elif start > 0:
+                count = MAX_ROWS
+            else:
+                count = None
+            if count != None and start > 0:
+                return u' LIMIT %s, %s', [start, count]
+            elif count != None:
+                return u' LIMIT %s', [count]
+        elif self.batch_size:
+            # Streams can't scroll.
+            raise ValueError('Streams do not support negative indexes.')
+        elif stop != None and stop > 0:
+            return u' LIMIT %s', [stop]
+        return u'', []
         
-        # WHERE instructions
-        if len(self.where_fields) > 0:
-            where_clauses = []
-            for key, value in self.where_fields.iteritems():
-                where_clauses.append(self.get_where_clause(key, value))
-            where = u' WHERE %s' % ' AND '.join(where_clauses)
+    def build_sql(self, limit):
+        """
+        Builds the statement around the given LIMIT clause.
+        """
+        where = self.get_where_sql()
+        order = u''
         
         # ORDER instructions (only will be used for SELECT)
         if len(self.order_fields):
             order_clauses = []
-            for key, value in self.order_fields.iteritems():
+            for key, value in self.order_fields:
+                if key in self.fields:
+                    # Joined tables can have the same column names.
+                    key = u'%s.%s' % (self.model.table(), key)
                 order_clauses.append(u'%s %s' % (key, value))
-            order = u' ORDER BY %s' % ' AND '.join(order_clauses)
-            
-        # LIMIT instructions
-        if self.slice.stop != None and self.slice.stop > 0:
-            limit = u' LIMIT %d' % self.slice.stop
+            order = u' ORDER BY %s' % u', '.join(order_clauses)
             
         # SELECT statement if operation not set by delete(), insert(), etc.
-        if not self.operation:
-            fields = [u'%s.%s' % (self.model.table(), f) for f in self.fields]
+        if not self.operation and self.projection:
+            fields = [u'%s.%s' % (self.model.table(), f) 
+                for f in self.projection]
+            self.joins = []
             self.operation = u"SELECT %s FROM %s" % \
                 (u', '.join(fields), u', '.join(self.tables))
+        elif not self.operation and not self.related and \
+            not self.selected and len(self.tables) == 1:
+            # The plain SELECT was compiled along with the model.
+            self.joins = []
+            self.operation = self.model._sql['select']
+        elif not self.operation:
+            fields = [u'%s.%s' % (self.model.table(), f) 
+                for f in self.selected or self.fields]
+            tables = u', '.join(self.tables)
+            self.joins = self.get_joins()
+            if self.joins and len(self.tables) > 1:
+                # JOIN binds tighter than the comma.
+                tables = u'(%s)' % tables
+            for path, parent, field, model in self.joins:
+                alias = self.get_alias(path)
+                fields.extend([u'%s.%s' % (alias, f) for f in model.fields()])
+                tables += u' LEFT JOIN %s AS %s ON %s.%s = %s.%s' % (
+                    model.table(), alias, alias, model.get_primary(),
+                    self.get_alias(parent), field)
+            self.operation = u"SELECT %s FROM %s" % \
+                (u', '.join(fields), tables)
         else:
             # No order for DELETE, UPDATE, etc.
             order = u''
             
         return u'%s%s%s%s;' % (self.operation, where, order, limit)
         
-    def get_where_clause(self, key, value):
+    def check_order(self):
         """
-        Takes a key and a value and turns it into an appropriate
-        where clause.
+        Warns when the ORDER BY can't be read off one of the model's
+        indexes, so MySQL would have to filesort the matching rows,
+        and the table has more than FILESORT_ROWS of them.
         """
-        if type(key) is ReferenceField:
-            ref = key.model
-            for field in ref.fields():
-                if object.__getattribute__(ref, field) == key:
-                    key = u'%s.%s' % (ref.table(), field)
+        problem = self.get_order_problem()
+        if problem is None:
+            return
+        rows = estimate_rows(self.model)
+        if rows <= FILESORT_ROWS:
+            return
+        message = u'ORDER BY %s on %s (about %d rows) will filesort: %s.' % (
+            u', '.join([u'%s %s' % pair for pair in self.order_fields]),
+            self.model.table(), rows, problem)
+        logging.getLogger('Norm').warning(message)
+        if connection.verbose:
+            print message
+            
+    def get_order_problem(self):
+        """
+        Returns why no index can serve the ORDER BY, or None if one
+        can. Columns limited to a single value don't need sorting,
+        and InnoDB secondary indexes end with the primary.
+        """
+        if len(set([value for key, value in self.order_fields])) > 1:
+            return u'it mixes ASC and DESC'
+        for key, value in self.order_fields:
+            if key not in self.fields:
+                return u'%s is not a column on %s' % (key, self.model.table())
+        prefix = u'%s.' % self.model.table()
+        equal = []
+        for (key, operator), value in self.where_fields.iteritems():
+            if type(key) is not ReferenceField and key.startswith(prefix) and \
+                operator == 'exact' and value is not None and \
+                type(value) is not ReferenceField:
+                equal.append(key[len(prefix):])
+        order = [key for key, value in self.order_fields if key not in equal]
+        if not order:
+            return None
+        primary = self.model.get_primary()
+        for kind, name, columns in self.model.indexes():
+            names = []
+            for column, length in columns:
+                if length is not None:
+                    # Prefix indexes can't be read in order.
                     break
-            if ref.table() not in self.tables:
-                self.tables.append(ref.table())
+                names.append(column)
+            else:
+                if primary not in names:
+                    names.append(primary)
+            while names and names[0] in equal:
+                names.pop(0)
+            if names[:len(order)] == order:
+                return None
+        return u'no index starts with %s' % u', '.join(order)
+        
+    def get_where_sql(self):
+        """
+        Builds the WHERE part of the statement, collecting the
+        tables it touches and the values to bind along the way.
+        """
+        self.tables = [self.model.table(),]
+        self.where_values = []
+        if not (self.where_fields or self.seek or self.or_groups):
+            return u''
+        where_clauses = self.get_conditions_sql(self.where_fields)
+        if self.seek:
+            column, value = self.seek
+            where_clauses.append(u'%s.%s > %%s' % (self.model.table(), column))
+            self.where_values.append(value)
+        for group in self.or_groups:
+            options = []
+            for conditions in group:
+                clauses = self.get_conditions_sql(conditions) or [u'1 = 1']
+                options.append(u'(%s)' % u' AND '.join(clauses))
+            where_clauses.append(u'(%s)' % (u' OR '.join(options) or u'0 = 1'))
+        return u' WHERE %s' % ' AND '.join(where_clauses)
+        
+    def get_conditions_sql(self, conditions):
+        """
+        Returns the clauses for a dict of conditions, adding their
+        values to where_values.
+        """
+        clauses = []
+        for (key, operator), value in conditions.iteritems():
+            clauses.append(self.get_where_clause(key, operator, value))
+            self.where_values.extend(get_condition_values(operator, value))
+        return clauses
+        
+    def get_where_values(self):
+        """
+        The values get_where_sql() binds, in the same order, without
+        building the clauses.
+        """
+        values = []
+        for (key, operator), value in self.where_fields.iteritems():
+            values.extend(get_condition_values(operator, value))
+        if self.seek:
+            values.append(self.seek[1])
+        for group in self.or_groups:
+            for conditions in group:
+                for (key, operator), value in conditions.iteritems():
+                    values.extend(get_condition_values(operator, value))
+        return values
+        
+    def get_where_clause(self, key, operator, value):
+        """
+        Takes a key, lookup and value and turns it into an
+        appropriate where clause. Placeholders are left for the
+        values get_condition_values() returns.
+        """
+        key = self.get_column(key)
         if type(value) is ReferenceField:
-            ref = value.model
-            for field in ref.fields():
-                if object.__getattribute__(ref, field) == value:
-                    value = u'%s.%s' % (ref.table(), field)
-                    break
-            if ref.table() not in self.tables:
-                self.tables.append(ref.table())
-        else:
-            # MySQLdb string substitution
-            self.values.append(value)
-            value = u'%s'
-        return u'%s = %s' % (key, value)
+            return u'%s %s %s' % (key, OPERATORS[operator], 
+                self.get_column(value))
+        if operator == 'isnull':
+            if value:
+                return u'%s IS NULL' % key
+            return u'%s IS NOT NULL' % key
+        if value is None and operator == 'exact':
+            return u'%s IS NULL' % key
+        if value is None and operator == 'ne':
+            return u'%s IS NOT NULL' % key
+        if isinstance(value, Results):
+            subquery = value.get_subquery_sql()
+            if self.operation and self.model.table() in value.tables:
+                # MySQL won't UPDATE or DELETE from a table a subquery
+                # reads, unless the subquery is materialized first.
+                subquery = u'SELECT * FROM (%s) AS subquery' % subquery
+            return u'%s IN (%s)' % (key, subquery)
+        if operator == 'in':
+            if not value:
+                return u'0 = 1'
+            return u'%s IN (%s)' % (key, u', '.join([u'%s'] * len(value)))
+        if operator == 'range':
+            return u'%s BETWEEN %%s AND %%s' % key
+        # MySQLdb string substitution
+        return u'%s %s %%s' % (key, OPERATORS[operator])
         
-    def __iter__(self):
+    def get_subquery_sql(self):
+        """
+        Returns this query as a subquery for an IN (...) in another
+        Results -- a SELECT of the values() column, or the primary
+        if there isn't one. Its values go in the outer query's
+        where_values (see get_condition_values()).
+        """
+        if self.projection and len(self.projection) != 1:
+            raise ValueError('A subquery must select a single column.')
+        if self.slice != slice(None, None, None):
+            raise ValueError('MySQL does not support LIMIT in IN subqueries.')
+        column = self.model.get_primary()
+        if self.projection:
+            column = self.projection[0]
+        where = self.get_where_sql()
+        return u'SELECT %s.%s FROM %s%s' % (self.model.table(), column,
+            u', '.join(self.tables), where)
+        
+    def get_subquery_tables(self):
+        """
+        The tables read by subqueries in the conditions, so the
+        query cache knows what invalidates this query.
+        """
+        tables = []
+        for conditions in [self.where_fields] + \
+            [c for group in self.or_groups for c in group]:
+            for value in conditions.values():
+                if isinstance(value, Results):
+                    tables.append(value.model.table())
+                    for key in value.where_fields.keys():
+                        if type(key[0]) is ReferenceField:
+                            tables.append(key[0].model.table())
+                    tables.extend(value.get_subquery_tables())
+        return tables
+        
+    def get_column(self, column):
+        """
+        Returns the 'table.column' for a condition's column, which
+        may be a ReferenceField on another model (whose table is then
+        added to the statement).
         """
-        Gets the SQL and makes the call, then stores
-        the result on the class for the __next__() call(s).
+        if type(column) is not ReferenceField:
+            return column
+        ref = column.model
+        if ref.table() not in self.tables:
+            self.tables.append(ref.table())
+        return u'%s.%s' % (ref.table(), column.name)
+        
+    def _execute(self):
+        """
+        Gets the SQL and makes the call (once), keeping the
+        cursor on the class for the next() call(s).
         """
         if not connection.connected:
             raise Exception('Not connected to the database.')
+        if self.instances is not None:
+            return
         if not self.cursor:
-            sql = self.get_sql()
-            self.cursor = connection.execute(sql, tuple(self.values))
+            key = self.get_chunked_in()
+            if key is not None:
+                self.cursor = self.execute_chunked(key)
+            else:
+                sql = self.get_sql()
+                values = tuple(self.set_values + self.where_values + 
+                    self.limit_values)
+                if self.batch_size:
+                    self.check_size(sql, values)
+                    self.db = connection.checkout(dedicated=True)
+                    cursor = self.db.connection.cursor(SSCursor)
+                    self.cursor = self.db.execute(sql, values, cursor)
+                elif self.cache_ttl is not None and \
+                    self.operation.startswith('SELECT'):
+                    self.cursor = RowCursor(self.fetch_all(sql, values, 
+                        self.get_read_tables()))
+                else:
+                    self.check_size(sql, values)
+                    self.db = connection.checkout()
+                    self.cursor = self.db.execute(sql, values)
+            self.current_row = 0
+            if not self.operation.startswith('SELECT'):
+                self.invalidate_session()
+                query_cache.invalidate(self.model.table())
+                
+    def get_read_tables(self):
+        """
+        Every table the SELECT reads from, joins and subqueries
+        included, for the query cache.
+        """
+        return self.tables + [model.table() 
+            for path, parent, field, model in self.joins] + \
+            self.get_subquery_tables()
+            
+    def get_chunked_in(self):
+        """
+        Returns the key of the longest in list with more than
+        IN_CHUNK values, if the query can be run once per IN_CHUNK
+        of them with the rows simply put together -- so no order,
+        slice, stream or grouping that would span the chunks.
+        """
+        if self.order_fields or self.group_fields or self.batch_size or \
+            self.seek or self.slice != slice(None, None, None):
+            return None
+        longest = None
+        for key, value in self.where_fields.iteritems():
+            if key[1] != 'in' or isinstance(value, Results) or \
+                len(value) <= IN_CHUNK:
+                continue
+            if longest is None or len(value) > len(self.where_fields[longest]):
+                longest = key
+        return longest
+        
+    def execute_chunked(self, key):
+        """
+        Runs the query once for each IN_CHUNK values of the in list
+        at key, and returns a RowCursor over all of the rows (with
+        the total rowcount, for an UPDATE or DELETE).
+        """
+        # Without repeats, no row can match in two chunks.
+        seen = set()
+        unique = []
+        for value in self.where_fields[key]:
+            if value not in seen:
+                seen.add(value)
+                unique.append(value)
+        rows = []
+        rowcount = 0
+        for chunk in chunked(unique, IN_CHUNK):
+            part = self.clone()
+            part.where_fields[key] = chunk
+            sql = part.get_sql()
+            values = tuple(part.set_values + part.where_values)
+            if part.operation.startswith('SELECT'):
+                rows.extend(part.fetch_all(sql, values, 
+                    part.get_read_tables()))
+            else:
+                cursor = connection.execute(sql, values)
+                rowcount += cursor.rowcount
+                connection.release_cursor(cursor)
+        self.operation = part.operation
+        self.tables = part.tables
+        self.joins = part.joins
+        cursor = RowCursor(rows)
+        if not self.operation.startswith('SELECT'):
+            cursor.rowcount = rowcount
+        return cursor
+        
+    def check_size(self, sql, values):
+        """
+        Raises ValueError if a statement with a long in list (one
+        get_chunked_in() couldn't split up) won't fit in the
+        server's max_allowed_packet.
+        """
+        if len(values) <= IN_CHUNK:
+            return
+        from Norm.model import estimate_size
+        if len(sql) + estimate_size(values) > connection.max_allowed_packet():
+            raise ValueError('The statement is bigger than max_allowed_packet. '
+                'Long in lists are only split up without order(), slices, '
+                'stream(), group_by() or aggregates.')
+        
+    def invalidate_session(self):
+        """
+        Drops the rows an UPDATE or DELETE touched from the current
+        Session -- just the one if it was limited by primary key,
+        otherwise every instance of the model.
+        """
+        session = current_session()
+        if session is None:
+            return
+        primary_column = u'%s.%s' % (self.model.table(), 
+            self.model.get_primary())
+        conditions = self.where_fields.keys()
+        if self.or_groups or len(conditions) != 1 or \
+            conditions[0][0] != primary_column:
+            session.invalidate(self.model)
+        elif conditions[0][1] == 'exact':
+            session.invalidate(self.model, self.where_fields[conditions[0]])
+        elif conditions[0][1] == 'in' and \
+            not isinstance(self.where_fields[conditions[0]], Results):
+            for primary in self.where_fields[conditions[0]]:
+                session.invalidate(self.model, primary)
+        else:
+            session.invalidate(self.model)
+        
+    def __iter__(self):
+        """
+        Runs the query if it hasn't been yet, otherwise rewinds
+        the existing cursor so the rows aren't fetched again.
+        Streams can't rewind, so they just run the query again.
+        """
+        if self.instances is not None:
+            self.pending = deque(self.instances[self.slice])
+            self.current_row = 0
+            return self
+        if self.cursor and self.current_row > 0:
+            self.pending.clear()
+            if self.batch_size:
+                self.close()
+            else:
+                self.cursor.scroll(0, 'absolute')
+                self.current_row = 0
+        self._execute()
         return self
         
+    def close(self):
+        """
+        Closes the cursor (freeing its rows) and lets go of its
+        Connection. Iterating again afterwards re-runs the query.
+        """
+        if not self.cursor:
+            return
+        if self.batch_size:
+            # Closing reads off whatever the server still has queued.
+            self.cursor.close()
+            connection.checkin(self.db)
+            self.batch.clear()
+        elif self.db is None:
+            # Rows from the query cache -- there's no real cursor.
+            pass
+        else:
+            self.db.release_cursor(self.cursor)
+        self.cursor = None
+        self.db = None
+        self.pending.clear()
+            
+    def __del__(self):
+        self.close()
+        
     def next(self):
         """
         Grabs the next result (if there is one) and returns
@@ -219,10 +948,112 @@ class Results(object):
         TODO: Implement a mass "DELETE" process which also
         calls the delete() method for each result.
         """
+        if self.projection:
+            row = self.next_row()
+            if self.projection_type == 'flat':
+                return self.converters[0](row[0])
+            values = [convert(value) 
+                for convert, value in zip(self.converters, row)]
+            if self.projection_type == 'dict':
+                return dict(zip(self.projection, values))
+            return tuple(values)
+        if self.instances is not None or self.prefetch:
+            if not self.pending and self.instances is None:
+                self.fill_pending()
+            if not self.pending:
+                raise StopIteration
+            return self.pending.popleft()
+        return self.hydrate(self.next_row())
         
+    def next_row(self):
+        """
+        Returns the next raw row from the cursor.
+        """
         if not self.operation.startswith('SELECT'):
             raise StopIteration
+        if self.batch_size:
+            result = self.next_streamed()
+        else:
+            result = self.next_buffered()
+        self.current_row += 1
+        return result
+        
+    def fill_pending(self):
+        """
+        Hydrates the next batch of rows and runs the
+        prefetch_related() queries for all of them at once.
+        """
+        objs = []
+        try:
+            while len(objs) < (self.batch_size or PREFETCH_BATCH):
+                objs.append(self.hydrate(self.next_row()))
+        except StopIteration:
+            pass
+        if objs:
+            for name in self.prefetch:
+                prefetch_many(objs, name)
+        self.pending.extend(objs)
+        
+    def hydrate(self, row):
+        """
+        Builds the model instance for a row, along with any
+        select_related() instances that came back with it.
+        """
+        columns = self.selected or self.fields
+        if self.factory is None:
+            self.factory = self.model.row_factory(columns)
+        obj = build_instance(self.model, columns, row, self.factory)
+        if self.selected:
+            if self.deferred is None:
+                self.deferred = weakref.WeakValueDictionary()
+            self.deferred[obj.primary] = obj
+            obj.get_cache()['_deferred'] = self.deferred
+        if not self.joins:
+            return obj
+        instances = {'': obj}
+        offset = len(columns)
+        for path, parent, field, model in self.joins:
+            fields = model.fields()
+            values = row[offset:offset + len(fields)]
+            offset += len(fields)
+            parent_obj = instances.get(parent)
+            if parent_obj is None:
+                continue
+            if values[fields.index(model.get_primary())] is None:
+                # Nothing on the other side of the LEFT JOIN.
+                continue
+            related = build_instance(model, fields, values)
+            parent_obj.get_cache()[field] = related
+            instances[path] = related
+        return obj
         
+    def next_streamed(self):
+        """
+        Returns the next row of a stream, fetching another
+        batch from the server when the last one runs out. Once
+        the rows are exhausted the stream's Connection goes back.
+        """
+        if not self.batch:
+            if not self.cursor:
+                raise StopIteration
+            self.batch.extend(self.cursor.fetchmany(self.batch_size))
+            if not self.batch:
+                self.close()
+                raise StopIteration
+        return self.batch.popleft()
+        
+    def next_buffered(self):
+        """
+        Returns the next row from the client-side result set. If
+        the slice couldn't go in the LIMIT clause, it's honored here
+        with scroll() and rowcount.
+        """
+        if self.server_slice:
+            result = self.cursor.fetchone()
+            if result == None:
+                raise StopIteration
+            return result
+            
         if self.current_row == 0 and self.slice.start != None:
             index = 0
             if self.slice.start < 0:
@@ -244,12 +1075,7 @@ class Results(object):
         result = self.cursor.fetchone()
         if result == None:
             raise StopIteration
-        obj = self.model()
-        for i in range(len(self.fields)):
-            object.__getattribute__(obj, self.fields[i])._value = result[i]
-        object.__setattr__(obj, '_retrieved', True)
-        self.current_row += 1
-        return obj
+        return result
         
     def __getitem__(self, key):
         """
@@ -258,13 +1084,25 @@ class Results(object):
         if type(key) not in [types.SliceType, types.IntType]:
             raise TypeError
         if type(key) is types.IntType:
-            self.slice = slice(key, key+1)
+            self.set_slice(slice(key, key + 1 or None))
             for i in self:
                 return i
+            if self.operation.startswith('SELECT'):
+                raise IndexError('Index beyond number of rows.')
         else:
-            self.slice = key
+            self.set_slice(key)
             return self
             
+    def set_slice(self, key):
+        """
+        Sets the slice. A cursor that was already run has the old
+        one in its LIMIT (or scrolled for it), so it's closed, and
+        the query runs again for the new one.
+        """
+        if key != self.slice:
+            self.close()
+        self.slice = key
+            
     def limit(self, stop):
         """
         Just a quick wrapper around __getitem__
@@ -276,10 +1114,321 @@ class Results(object):
         Returns the number of rows from selection. Only works
         if __iter__ has already been called -- may need to 
         patch this.
+        
+        Streams don't know their rowcount until they're read, so
+        they raise TypeError (which list() takes as no length hint).
+        To count on the server, use count().
         """
-        if not self.cursor:
-            self.__iter__()
-        return self.cursor.rowcount
+        if self.instances is not None:
+            return len(self.instances[self.slice])
+        if self.batch_size:
+            raise TypeError('A stream has no len(), use count().')
+        self._execute()
+        if self.server_slice or not self.operation.startswith('SELECT'):
+            return self.cursor.rowcount
+        start, stop, step = self.slice.indices(self.cursor.rowcount)
+        return max(stop - start, 0)
+        
+    def clone(self):
+        """
+        Returns a copy with the same query modifiers that hasn't
+        been run yet.
+        """
+        other = copy.copy(self)
+        for attr in ['set_values', 'where_values', 'limit_values', 
+            'group_fields', 'tables', 'related', 'joins', 'prefetch', 
+            'converters', 'or_groups', 'order_fields']:
+            setattr(other, attr, list(getattr(self, attr)))
+        other.where_fields = dict(self.where_fields)
+        if self.operation and self.operation.startswith('SELECT'):
+            other.operation = None
+        other.db = None
+        other.cursor = None
+        other.current_row = 0
+        other.batch = deque()
+        other.pending = deque()
+        other.instances = None
+        other.deferred = None
+        return other
+        
+    def paginate_by(self, key=None, page_size=1000):
+        """
+        Walks the results a page at a time by seeking on a unique
+        column (the primary by default), so every page is
+        WHERE key > last ORDER BY key LIMIT page_size and a deep
+        page costs the same as the first. Yields a list of
+        instances per page. Any order or slice is ignored.
+        """
+        if key is None:
+            key = self.model.get_primary()
+        assert page_size > 0
+        last = None
+        while True:
+            page = self.clone()
+            page.order_fields = [(key, ASCENDING)]
+            page.slice = slice(0, page_size)
+            if last is not None:
+                page.seek = (key, last)
+            instances = list(page)
+            page.close()
+            if not instances:
+                return
+            yield instances
+            if len(instances) < page_size:
+                return
+            last = instances[-1].get_raw(key)
+        
+    def group_by(self, *columns):
+        """
+        Groups count() and aggregate() by the given columns.
+        """
+        self.check_columns(columns)
+        for column in columns:
+            if column not in self.group_fields:
+                self.group_fields.append(column)
+        return self
+        
+    def count(self):
+        """
+        Counts the matching rows on the server with COUNT(*), trimmed
+        to the slice. With group_by(), returns a dict of counts keyed
+        on the group value (or a tuple of them for several columns).
+        """
+        if self.group_fields:
+            counts = {}
+            for row in self.run_aggregate([u'COUNT(*)']):
+                counts[get_group_key(row[:-1])] = row[-1]
+            return counts
+        total = self.run_aggregate([u'COUNT(*)'])[0][0]
+        start, stop, step = self.slice.indices(total)
+        return max(stop - start, 0)
+        
+    def exists(self):
+        """
+        Whether any row matches, using SELECT 1 ... LIMIT 1.
+        Ignores the slice.
+        """
+        where = self.get_where_sql()
+        sql = u'SELECT 1 FROM %s%s LIMIT 1;' % (u', '.join(self.tables), where)
+        rows = self.fetch_all(sql, tuple(self.where_values),
+            self.tables + self.get_subquery_tables())
+        return len(rows) > 0
+        
+    def aggregate(self, **kwargs):
+        """
+        Runs aggregate functions on the server, keyed by function
+        with a column (or list of columns) as the value:
+        
+            Person.all().aggregate(sum='wage', avg='age')
+            
+        returns {'wage__sum': ..., 'age__avg': ...}. Use count='*'
+        for a plain row count (keyed 'count'). With group_by(), a
+        list of dicts is returned, one per group, which also hold
+        the group columns.
+        """
+        keys = []
+        columns = []
+        for function, fields in kwargs.iteritems():
+            if function not in AGGREGATES:
+                raise ValueError('Unknown aggregate %s.' % function)
+            if type(fields) not in [types.ListType, types.TupleType]:
+                fields = [fields]
+            for field in fields:
+                if function == 'count' and field == '*':
+                    keys.append('count')
+                    columns.append(u'COUNT(*)')
+                    continue
+                self.check_columns([field])
+                keys.append('%s__%s' % (field, function))
+                columns.append(u'%s(%s.%s)' % 
+                    (function.upper(), self.model.table(), field))
+        rows = self.run_aggregate(columns)
+        keys = self.group_fields + keys
+        if not self.group_fields:
+            return dict(zip(keys, rows[0]))
+        return [dict(zip(keys, row)) for row in rows]
+        
+    def run_aggregate(self, columns):
+        """
+        Runs a SELECT of the group_by() columns and the given
+        aggregate columns, with the WHERE clause from get_sql(),
+        and returns all the rows.
+        """
+        where = self.get_where_sql()
+        groups = [u'%s.%s' % (self.model.table(), f) 
+            for f in self.group_fields]
+        sql = u'SELECT %s FROM %s%s' % (u', '.join(groups + columns),
+            u', '.join(self.tables), where)
+        if groups:
+            sql += u' GROUP BY %s' % u', '.join(groups)
+        return self.fetch_all(sql + u';', tuple(self.where_values), 
+            self.tables + self.get_subquery_tables())
+        
+    def fetch_all(self, sql, values, tables):
+        """
+        Runs a SELECT that reads from the given tables and returns
+        all the rows -- through the query cache, if cached() was
+        called.
+        """
+        self.check_size(sql, values)
+        if self.cache_ttl is None:
+            cursor = connection.execute(sql, values)
+            rows = cursor.fetchall()
+            connection.release_cursor(cursor)
+            return rows
+        return query_cache.fetch(tables, sql, values, self.cache_ttl)
+            
+def prefetch_many(parents, name):
+    """
+    Loads the ReferenceManyField called name for a list of parent
+    instances, using chunked IN (...) queries, and hands each parent
+    a Results already filled with its share of the children.
+    """
+    model = parents[0].__class__
+    primaries = [parent.primary for parent in parents]
+    field = getattr(model, name)
+    field.get_foreign()
+    children = {}
+    if isinstance(field, ReferenceManyToManyField):
+        # One query through the intermediary table to map the
+        # parents to the other side, then one for the other side.
+        join_model = field.ref_table
+        ref_name = field.ref_field.name
+        join_name = field.join_field.name
+        target_ids = {}
+        for chunk in chunked(primaries, IN_CHUNK):
+            sql = u'SELECT %s, %s FROM %s WHERE %s IN (%s);' % (
+                ref_name, join_name, join_model.table(), ref_name,
+                u', '.join([u'%s'] * len(chunk)))
+            cursor = connection.execute(sql, tuple(chunk))
+            for parent_id, target_id in cursor.fetchall():
+                target_ids.setdefault(parent_id, []).append(target_id)
+            connection.release_cursor(cursor)
+        targets = {}
+        all_ids = set()
+        for ids in target_ids.values():
+            all_ids.update(ids)
+        target_model = field.join_table
+        for chunk in chunked(list(all_ids), IN_CHUNK):
+            results = Results(target_model)
+            for target in results.where_in(target_model.get_primary(), chunk):
+                targets[target.primary] = target
+        for parent_id, ids in target_ids.iteritems():
+            children[parent_id] = [targets[i] for i in ids if i in targets]
+    else:
+        child_model = field.ref_table
+        for chunk in chunked(primaries, IN_CHUNK):
+            results = Results(child_model).where_in(field.ref_field, chunk)
+            for child in results.order(child_model.get_primary()):
+                ref = child.get_raw(field.ref_field)
+                children.setdefault(ref, []).append(child)
+    for parent in parents:
+        results = field.get_results(parent)
+        results.instances = children.get(parent.primary, [])
+        parent.get_cache()[name] = results
+        
+def estimate_rows(model):
+    """
+    The server's estimate of how many rows a model's table has,
+    looked up once per table.
+    """
+    table = model.table()
+    if table not in ROW_ESTIMATES:
+        cursor = connection.execute(u'SELECT TABLE_ROWS FROM '
+            u'information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() '
+            u'AND TABLE_NAME = %s;', (table,))
+        row = cursor.fetchone()
+        connection.release_cursor(cursor)
+        ROW_ESTIMATES[table] = row and row[0] or 0
+    return ROW_ESTIMATES[table]
+    
+def format_lookup(field, operator, value):
+    """
+    Formats the value of a where() lookup with the field's
+    write conversion.
+    """
+    if operator == 'isnull':
+        return bool(value)
+    if operator == 'in':
+        return [field.write_value(item) for item in value]
+    if operator == 'range':
+        low, high = value
+        return [field.write_value(low), field.write_value(high)]
+    if operator == 'startswith':
+        # Escaping LIKE's wildcards, so the prefix can use an index.
+        value = field.write_value(value)
+        for char in u'\\%_':
+            value = value.replace(char, u'\\' + char)
+        return value + u'%'
+    return field.write_value(value)
+    
+def get_condition_values(operator, value):
+    """
+    The values bound for one where() condition.
+    """
+    if type(value) is ReferenceField or operator == 'isnull':
+        return []
+    if isinstance(value, Results):
+        return value.get_where_values()
+    if value is None and operator in ['exact', 'ne']:
+        return []
+    if operator in ['in', 'range']:
+        return list(value)
+    return [value]
+    
+def get_conditions_shape(conditions):
+    """
+    The part of Results.get_shape() for a dict of conditions --
+    whatever about them changes the SQL, but not the values.
+    """
+    shape = []
+    for (key, operator), value in conditions.iteritems():
+        if type(value) is ReferenceField:
+            marker = value
+        elif isinstance(value, Results):
+            marker = value.get_shape(u'')
+        elif operator == 'in':
+            marker = len(value)
+        elif operator == 'isnull':
+            marker = value
+        else:
+            marker = value is None
+        shape.append((key, operator, marker))
+    return tuple(shape)
+    
+def get_group_key(values):
+    """
+    A single group value, or a tuple of them for several columns.
+    """
+    if len(values) == 1:
+        return values[0]
+    return tuple(values)
+        
+def chunked(items, size):
+    """
+    Splits a list into lists of at most size items.
+    """
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def build_instance(model, fields, row, factory=None, checked=False):
+    """
+    Builds a model instance from row values, or returns the one
+    the current Session already has for that primary. Callers that
+    already looked in the Session pass checked=True, so the miss
+    isn't counted twice.
+    """
+    session = current_session()
+    if session is not None and not checked:
+        primary = row[fields.index(model.get_primary())]
+        obj = session.get(model, primary)
+        if obj is not None:
+            return obj
+    if factory is None:
+        factory = model.row_factory(fields)
+    obj = factory(row)
+    if session is not None:
+        session.add(obj)
+    return obj
             
 def get_model_limiter(instance):
     """
@@ -0,0 +1,118 @@
+"""
+NORM session.py
+
+Josh Marshall 2010
+This file contains the Session class, an opt-in identity map.
+"""
+
+import threading
+import weakref
+from collections import deque
+
+_LOCAL = threading.local()
+
+class Session(object):
+    """
+    The Session is an identity map keyed on (model, primary), so that
+    while it's active on a thread, Model.get() and Results hand back
+    the instance that was already loaded instead of a new copy.
+
+    Instances are held by weak references, plus strong references
+    to the max_size most recently loaded ones (so something like
+    person.city read twice in a row doesn't hit the table again).
+    A max_size of None keeps everything alive until clear().
+    """
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._instances = weakref.WeakValueDictionary()
+        self._recent = deque()
+        self._previous = None
+
+    def begin(self):
+        """
+        Makes this the current Session for the calling thread.
+        """
+        self._previous = current_session()
+        _LOCAL.session = self
+        return self
+
+    def end(self):
+        """
+        Stops using this Session on the calling thread (restoring
+        whichever one was active before begin()) and clears it.
+        """
+        _LOCAL.session = self._previous
+        self._previous = None
+        self.clear()
+
+    def get(self, model, primary):
+        """
+        Returns the loaded instance for the primary, or None.
+        """
+        instance = self._instances.get((model, primary))
+        if instance is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return instance
+
+    def add(self, instance):
+        """
+        Stores an instance (which needs a primary value).
+        """
+        primary = instance.primary
+        if primary is None:
+            return
+        self._instances[(instance.__class__, primary)] = instance
+        if self.max_size != 0:
+            self._recent.append(instance)
+            if self.max_size is not None and len(self._recent) > self.max_size:
+                self._recent.popleft()
+
+    def invalidate(self, model, primary=None):
+        """
+        Forgets one instance, or every instance of the model if
+        no primary is given. The strong references are left to
+        age out on their own.
+        """
+        if primary is not None:
+            try:
+                del self._instances[(model, primary)]
+            except KeyError:
+                pass
+            return
+        for key in self._instances.keys():
+            if key[0] is model:
+                try:
+                    del self._instances[key]
+                except KeyError:
+                    pass
+
+    def clear(self):
+        """
+        Empties the map and resets the counters.
+        """
+        self._instances = weakref.WeakValueDictionary()
+        self._recent.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """
+        Returns a dict of hits, misses and the number of entries.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._instances)
+        }
+
+    def __len__(self):
+        return len(self._instances)
+
+def current_session():
+    """ Returns the Session active on this thread, if any. """
+    return getattr(_LOCAL, 'session', None)
@@ -15,9 +15,15 @@ Or, to print out the SQL statements:
 from Norm.model import Model
 from Norm.fields import PrimaryField, UnicodeField, ReferenceField
 from Norm.fields import BoolField, CreatedField, TimestampField
-from Norm.fields import DictField, IntField, FloatField
+from Norm.fields import DictField, IntField, FloatField, ReferenceManyField
+from Norm.fields import ListField, Index, DEFERRED, ZLIB, STORED
 from Norm.connection import connection
+from Norm.session import Session
+from Norm.cache import query_cache
 import time
+import pickle
+import marshal
+import threading
 
 class State(Model):
     """ Test State model"""
@@ -42,6 +48,44 @@ class Person(Model):
     email = UnicodeField(length=100, unique=True)
     age = IntField(index=True, default=40)
     wage = FloatField(default=3.95)
+    
+    class Meta:
+        engine = 'InnoDB'
+        indexes = [Index('city', 'age')]
+
+City.people = ReferenceManyField(Person)
+
+class Stamped(Model):
+    """ Test base model, never created itself """
+    id = PrimaryField()
+    created = CreatedField()
+    
+class Visit(Stamped):
+    """ Test model inheriting id and created """
+    page = UnicodeField(length=100)
+    
+class Login(Stamped):
+    """ Another one, with different columns """
+    ip = UnicodeField(length=40)
+    attempts = IntField(default=1)
+    
+class Hit(Model):
+    """ Test model partitioned by day """
+    id = PrimaryField()
+    path = UnicodeField(length=200)
+    created = CreatedField()
+    
+    class Meta:
+        engine = 'InnoDB'
+        partition = 'created'
+        partition_ahead = 2
+
+class Note(Model):
+    """ Test model with compressed and codec columns """
+    id = PrimaryField()
+    body = UnicodeField(compress=True, compress_threshold=64)
+    payload = DictField(compress=True)
+    tags = ListField(codec=marshal)
 
 STATE = State(name=u'Texas')
 CITY = City(name=u'Austin')
@@ -98,6 +142,28 @@ def add_users():
         users += 1
     print '%s user(s) added.' % users
 
+def bulk_add_users():
+    """ Insert a bunch of users with multi-row INSERTs. """
+    users = [Person(name=u'bulk %d' % i, city=CITY) for i in range(2000)]
+    Person.bulk_insert(users, chunk_size=500)
+    ids = [user.id for user in users]
+    assert len(set(ids)) == len(ids)
+    assert Person.get(ids[-1]).name == u'bulk 1999'
+    missing = []
+    found = Person.get_many(ids[::-1] + [0], missing=missing)
+    assert found[0].name == u'bulk 1999' and found[-1] is None
+    assert missing == [0]
+    print '%s user(s) added.' % len(users)
+
+def bulk_update_users():
+    """ Update a bunch of users with batched UPDATEs. """
+    users = list(Person.all()[:500])
+    for user in users:
+        user.age = 30
+    Person.bulk_save(users)
+    assert Person.get(users[-1].id).age == 30
+    print '%s user(s) updated.' % len(users)
+
 def get_user():
     """ Get a single user from the database. """
     wilbur = Person.fetch_one({'name':u'Wilbur'})
@@ -106,11 +172,145 @@ def get_user():
         return
     for field in Person.fields():
         print '%s: %s' % (field, getattr(wilbur, field))
+    copied = pickle.loads(pickle.dumps(wilbur))
+    assert copied == wilbur and copied.address == wilbur.address
     
 def get_users():
     """ Get a bunch of users from the database. """
     people = Person.all().reverse()[5:20]
     print '%s people found.' % len(people)
+    ordered = Person.all().order('age').order('id', 'DESC')[:100]
+    keys = [(person.age, -person.id) for person in ordered]
+    assert keys == sorted(keys)
+    # Counting first, then paging through the same Results.
+    everyone = Person.all()
+    total = len(everyone)
+    page = [person.id for person in everyone[5:10]]
+    assert page == [person.id for person in Person.all()[5:10]]
+    assert everyone[3].id == Person.all()[3].id
+    assert len(everyone[:]) == total
+    
+def values_users():
+    """ Read a few columns without building Person objects. """
+    names = list(Person.all().values_list('name', flat=True))
+    rows = list(Person.where({'name':u'Wilbur'}).values('id', 'address'))
+    assert rows[0]['address']['city'] == 'Austin'
+    print '%s names, %s' % (len(names), rows[0])
+    
+def deferred_users():
+    """ Leave columns out of the SELECT and load them on first read. """
+    people = list(Person.where({'city':CITY}).defer('address')[:50])
+    assert people[-1].get_raw('address') is DEFERRED
+    # Reading one loads the column for all of them.
+    assert people[0].address['city'] == 'Austin'
+    assert people[-1].get_raw('address') is not DEFERRED
+    names = list(Person.all().only('name')[:10])
+    assert names[0].get_raw('age') is DEFERRED
+    assert names[0].load_deferred('age') == names[0].get_raw('age')
+    assert names[0].age == Person.get(names[0].id).age
+    print '%s people loaded without their address.' % len(people)
+    
+def chunk_users():
+    """ Walk the whole table a page at a time. """
+    pages = 0
+    seen = 0
+    for page in Person.iter_chunks(page_size=250):
+        pages += 1
+        seen += len(page)
+    assert seen == Person.all().count()
+    print '%s people in %s pages.' % (seen, pages)
+    
+def count_users():
+    """ Count and aggregate users on the server. """
+    total = Person.all().count()
+    assert Person.where({'name':u'Wilbur'}).exists()
+    print '%s people, %s' % (total, Person.all().aggregate(avg='age', max='wage'))
+    print Person.all().group_by('city').count()
+    
+def lookup_users():
+    """ Filter users with lookups and OR groups. """
+    total = Person.all().count()
+    young = Person.where({'age__lt':30}).count()
+    assert Person.where({'age__gte':30}).count() == total - young
+    ids = sorted([person.id for person in Person.all()[:1500]])
+    assert Person.where({'id__in':ids}).count() == 1500
+    # Past IN_CHUNK ids, plain iteration runs a query per chunk.
+    assert len(list(Person.where({'id__in':ids + ids[:10]}))) == 1500
+    assert Person.where({'id__in':[]}).count() == 0
+    assert Person.where({'id__range':(ids[0], ids[9])}).count() == 10
+    # bulk 1, bulk 10-19, bulk 100-199 and bulk 1000-1999.
+    assert Person.where({'name__startswith':u'bulk 1'}).count() == 1111
+    assert Person.where({'city__isnull':True}).count() == 0
+    either = Person.all().where_any({'name':u'Wilbur'}, {'name':u'1'})
+    assert either.count() == 2
+    print '%s people, %s under 30.' % (total, young)
+    
+def subquery_users():
+    """ Filter people on their city's columns in one query. """
+    austin = City.where({'name':u'Austin'}).values('id')
+    people = Person.where({'city__in':austin})
+    assert people.count() == Person.where({'city':CITY}).count()
+    print '%s people in Austin.' % people.count()
+    
+def cached_users():
+    """ Serve repeat reads from the query cache until a write. """
+    query_cache.clear()
+    austin = City.where({'name':u'Austin'}).values('id')
+    first = len(Person.where({'city__in':austin}).cached())
+    assert Person.where({'city__in':austin}).cached().exists()
+    assert len(Person.where({'city__in':austin}).cached()) == first
+    assert query_cache.stats()['hits'] == 1
+    # A write to the subquery's table throws out both entries.
+    City.where({'name':u'Austin'}).update({'landlocked':True}).run()
+    assert Person.where({'city__in':austin}).cached().exists()
+    assert query_cache.stats()['misses'] == 3
+    print query_cache.stats(), query_cache.backend.entries.stats()
+    
+def related_users():
+    """ Load people with their cities and states in one query. """
+    people = Person.all().select_related('city__state')[:100]
+    states = set()
+    for person in people:
+        states.add(person.city.state.name)
+    print '%s people from %s.' % (len(people), ', '.join(states))
+    
+def prefetch_users():
+    """ Load the people for every city in one extra query. """
+    for city in City.all().prefetch_related('people'):
+        print '%s: %s people' % (city.name, len(city.people))
+    
+def session_users():
+    """ Verify the identity map hands back the same instances. """
+    session = Session().begin()
+    wilbur = Person.fetch_one({'name':u'Wilbur'})
+    assert wilbur.city is wilbur.city
+    assert Person.get(wilbur.id) is wilbur
+    print session.stats()
+    session.end()
+    
+def stream_users():
+    """ Read users in batches from a server-side cursor. """
+    people = Person.all().stream(batch_size=100)[10:]
+    count = 0
+    for person in people:
+        count += 1
+    assert count == people.count()
+    assert len(list(Person.all().stream(batch_size=100))) == count + 10
+    print '%s people streamed.' % count
+    
+def threaded_users():
+    """ Read users from several threads sharing the pool. """
+    counts = []
+    def worker():
+        counts.append(len(Person.where({'city':CITY})))
+        connection.release()
+    threads = [threading.Thread(target=worker) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(counts)) == 1
+    print '%s threads read %s people each.' % (len(counts), counts[0])
     
 def update_user():
     """ Update a single user in the database. """
@@ -133,6 +333,62 @@ def compare_users():
     assert wilbur != other
     assert wilbur == wilbur
     
+def inherited_models():
+    """ Models that share a base keep their own columns. """
+    Visit.create_table()
+    Login.create_table()
+    visit = Visit(page=u'/home')
+    visit.save()
+    login = Login(ip=u'127.0.0.1', attempts=3)
+    login.save()
+    visit = Visit.get(visit.id)
+    login = Login.get(login.id)
+    assert visit.page == u'/home' and visit.created
+    assert login.ip == u'127.0.0.1' and login.attempts == 3
+    assert Visit.created is not Login.created
+    print 'Visit %s and Login %s loaded.' % (visit.id, login.id)
+    
+def compressed_notes():
+    """ Round-trip compressed and codec columns. """
+    Note.create_table()
+    body = u'\u00fcber ' * 100
+    note = Note(body=body, payload={'words':body.split()}, tags=[1, u'two', 3.0])
+    note.save()
+    short = Note(body=u'short', payload={}, tags=[])
+    short.save()
+    # Compressed past the threshold, just stored below it.
+    assert note.get_raw('body')[0] == ZLIB
+    assert short.get_raw('body')[0] == STORED
+    for saved in [note, short]:
+        loaded = Note.get(saved.id)
+        assert loaded.body == saved.body
+        assert loaded.payload == saved.payload
+        assert loaded.tags == saved.tags
+    print 'Stored %s bytes of body in %s.' % (len(body.encode('utf-8')), 
+        len(note.get_raw('body')))
+    
+def partitioned_hits():
+    """ Write to and rotate a table partitioned by day. """
+    Hit.create_table()
+    hits = [Hit(path=u'/%d' % i) for i in range(10)]
+    Hit.bulk_insert(hits)
+    hits = list(Hit.all())
+    for hit in hits:
+        hit.path = u'/moved' + hit.path
+    Hit.bulk_save(hits)
+    # Updated in place, not upserted into new rows.
+    assert Hit.all().count() == 10
+    assert Hit.where({'path__startswith':u'/moved/'}).count() == 10
+    added, dropped = Hit.rotate_partitions(keep=7)
+    assert not added and not dropped
+    tomorrow = time.time() + 86400
+    added, dropped = Hit.rotate_partitions(keep=7, now=tomorrow)
+    assert len(added) == 1 and not dropped
+    # Today's partition (and its rows) age out of a window of none.
+    added, dropped = Hit.rotate_partitions(keep=0, now=tomorrow)
+    assert len(dropped) == 1 and Hit.all().count() == 0
+    print 'Added %s, dropped %s.' % (added, dropped)
+    
 def delete_user():
     """ Delete a single user. """
     wilbur = Person.fetch_one({'name':u'Wilburt'})
@@ -147,6 +403,10 @@ def delete_tables():
     Person.drop_table()
     State.drop_table()
     City.drop_table()
+    Visit.drop_table()
+    Login.drop_table()
+    Hit.drop_table()
+    Note.drop_table()
   
 def test(verbose=False):
     """ Connect to a local database and run all the tests. """
@@ -154,8 +414,13 @@ def test(verbose=False):
     delete_tables()
     for test_func in [
         create_tables, add_city, add_user,
-        add_users, get_user, get_users, 
-        update_user, update_users, compare_users, 
+        add_users, bulk_add_users, bulk_update_users,
+        get_user, get_users, values_users, deferred_users, chunk_users,
+        count_users, lookup_users, subquery_users, cached_users,
+        related_users, prefetch_users,
+        session_users, stream_users, threaded_users,
+        update_user, update_users, compare_users, inherited_models,
+        compressed_notes, partitioned_hits,
         delete_user, delete_users, delete_tables
     ]:
         run_test(test_func)